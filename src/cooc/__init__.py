@@ -10,8 +10,20 @@ STR_SEPARATOR_FOR_BIGRAMS = "|$|"
 APPLY_EDGE_CORRECTION = True
 SIGNIFICANCE_RANGE = 0.05
 N_MONTE_CARLO_SIMULATIONS = 500
+'''
+If True, the Monte Carlo simulations of a bigram stop as soon as further simulations cannot change its relationship at SIGNIFICANCE_RANGE.
+The relationships are the same as running all N_MONTE_CARLO_SIMULATIONS simulations.
+'''
+SEQUENTIAL_MONTE_CARLO = False
 KFUNCTION_DELTA_DISTANCE_KM = 0.5
+'''
+Further distances analyzed in the same run, reusing the trees and random samples of KFUNCTION_DELTA_DISTANCE_KM.
+For each distance, its relationship and kscore are appended as two more columns to the lines of data.kscore_analysis_file.
+The classification uses the relationship at KFUNCTION_DELTA_DISTANCE_KM.
+'''
+KFUNCTION_ADDITIONAL_DELTA_DISTANCES_KM = []
 MIN_TERM_FREQUENCY = 5
+CHECKPOINT_INTERVAL_TOKENS = 100
 
 class Relationship: ATTRACTION, NOTHING_SIGNIFICANT, REPULSION = range(3)
 
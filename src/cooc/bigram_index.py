@@ -0,0 +1,60 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: This file includes the index of bigrams in training data, which is built in a single pass over the tweets.
+A bigram is a pair of consecutive token ids (left, right). The index keeps the tweets containing each bigram and the bigrams of each token,
+so the co-occurrence analysis of a primary token receives its candidate bigrams without scanning its tweets. 
+'''
+
+import numpy as np
+from array import array
+
+class BigramIndex:
+    def __init__(self, tokens_dictionary, tgms, min_frequency):
+        number_of_tokens = len(tokens_dictionary)
+        token_ids_left, token_ids_right, tgm_indices = get_bigram_occurrences(tokens_dictionary, tgms)
+        keys = token_ids_left.astype(np.int64) * number_of_tokens + token_ids_right
+        order = np.lexsort((tgm_indices, keys))
+        keys, tgm_indices = keys[order], tgm_indices[order]
+        # a bigram is counted once per tweet
+        is_first_in_tgm = np.ones(len(keys), dtype=bool)
+        is_first_in_tgm[1:] = (keys[1:] != keys[:-1]) | (tgm_indices[1:] != tgm_indices[:-1])
+        keys, tgm_indices = keys[is_first_in_tgm], tgm_indices[is_first_in_tgm]
+        unique_keys, counts = np.unique(keys, return_counts=True)
+
+        is_frequent = counts >= min_frequency
+        self.tgm_indices = tgm_indices[np.repeat(is_frequent, counts)]
+        self.counts = counts[is_frequent]
+        self.indptr = np.concatenate(([0], np.cumsum(self.counts)))
+        self.token_ids_left = unique_keys[is_frequent] // number_of_tokens
+        self.token_ids_right = unique_keys[is_frequent] % number_of_tokens
+
+        bigram_ids = np.arange(len(self.counts))
+        is_not_repeated_token = self.token_ids_left != self.token_ids_right
+        token_ids = np.concatenate((self.token_ids_left, self.token_ids_right[is_not_repeated_token]))
+        bigram_ids_of_tokens = np.concatenate((bigram_ids, bigram_ids[is_not_repeated_token]))
+        order = np.lexsort((bigram_ids_of_tokens, -self.counts[bigram_ids_of_tokens], token_ids))
+        self.bigram_ids_of_tokens = bigram_ids_of_tokens[order]
+        self.token_indptr = np.concatenate(([0], np.cumsum(np.bincount(token_ids, minlength=number_of_tokens))))
+
+    def get_bigram_ids_of_token_id(self, token_id):
+        # ordered by decreasing frequency of bigrams
+        return self.bigram_ids_of_tokens[self.token_indptr[token_id]:self.token_indptr[token_id + 1]]
+
+    def get_tgm_indices_of_bigram_id(self, bigram_id):
+        return self.tgm_indices[self.indptr[bigram_id]:self.indptr[bigram_id + 1]]
+
+    def __len__(self):
+        return len(self.counts)
+
+def get_bigram_occurrences(tokens_dictionary, tgms):
+    token_ids_left = array('i')
+    token_ids_right = array('i')
+    tgm_indices = array('i')
+    for tgm_index, tgm in enumerate(tgms):
+        token_ids = [tokens_dictionary[token] for token in tgm.tokens]
+        token_ids_left.extend(token_ids[:-1])
+        token_ids_right.extend(token_ids[1:])
+        tgm_indices.extend([tgm_index] * (len(token_ids) - 1))
+    return np.frombuffer(token_ids_left, dtype=np.int32), np.frombuffer(token_ids_right, dtype=np.int32), np.frombuffer(tgm_indices, dtype=np.int32)
@@ -7,73 +7,147 @@
 
 import logging
 import logger_settings
-from data import datareader
+from data import datareader, token_index
 import data
 import cooc
 import numpy as np
 from geopy.distance import great_circle
-from cooc import ripley_k_function
+from cooc import ripley_k_function, bigram_index
 import math
+import argparse
+import multiprocessing
+import os
+
+'''
+Training data shared with the worker processes of a parallel run. It is set before the worker processes are forked,
+so the workers read the same arrays and tweets without pickling them for every primary token.
+'''
+shared_analysis_data = None
+
+PROGRESS_FILE_SUFFIX = ".progress"
 
 def main():
+    parser = argparse.ArgumentParser(description='Finds the bigrams with attraction-repulsion patterns in training data.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes that analyze the primary tokens in parallel.')
+    parser.add_argument('--resume', action='store_true', help='Skip the primary tokens completed by a previous run and append to its output.')
+    args = parser.parse_args()
     logger_settings.setLoggers()
     grid = datareader.readGrid(data.grid_file)
-    tgms_training = datareader.readTweetGridMaps(data.training_file)
-    tokens_set = set()
-    for tgm in tgms_training:
-        tokens_set = tokens_set.union(set(tgm.tokens))
-    tokens_list = list(tokens_set)
+    tgms_training = datareader.read_tweet_corpus(data.training_file)
+    tokens_list = list(tgms_training.tokens_list)
     tokens_list.sort()
     
     tokens_dictionary = {}
     for i in range(len(tokens_list)):
         token = tokens_list[i]
         tokens_dictionary[token] = i
-    find_attration_repulsion_pairs(grid, tokens_dictionary, tgms_training, tokens_list)
+    find_attration_repulsion_pairs(grid, tokens_dictionary, tgms_training, tokens_list, args.workers, args.resume)
     logging.info("Finished finding attraction-repulsion bigrams")  
 
-def find_attration_repulsion_pairs(grid, tokens_dictionary, tgms_training, tokens_list):
-    logging.info("Starting find_attration_repulsion_pairs. KFUNCTION_DELTA_DISTANCE_KM: " + str(cooc.KFUNCTION_DELTA_DISTANCE_KM) + ", N_MONTE_CARLO_SIMULATIONS: " + str(cooc.N_MONTE_CARLO_SIMULATIONS))
-    sparse_rowArr, sparse_colArr = get_sparse_feature_matrix(tokens_dictionary, tgms_training)
+def find_attration_repulsion_pairs(grid, tokens_dictionary, tgms_training, tokens_list, workers=1, resume=False):
+    global shared_analysis_data
+    delta_distances_km = [cooc.KFUNCTION_DELTA_DISTANCE_KM] + list(cooc.KFUNCTION_ADDITIONAL_DELTA_DISTANCES_KM)
+    logging.info("Starting find_attration_repulsion_pairs. KFUNCTION_DELTA_DISTANCES_KM: " + str(delta_distances_km) + ", N_MONTE_CARLO_SIMULATIONS: " + str(cooc.N_MONTE_CARLO_SIMULATIONS) + ", workers: " + str(workers))
+    tokens_index = token_index.TokenIndex(tokens_dictionary, tgms_training)
+    bigrams_index = bigram_index.BigramIndex(tokens_dictionary, tgms_training, cooc.MIN_TERM_FREQUENCY)
+    logging.info("Found " + str(len(bigrams_index)) + " bigrams with frequency >= " + str(cooc.MIN_TERM_FREQUENCY))
     area = get_grid_area(grid)
-    for tgm in tgms_training:
-        tgm.cartesian_coordinates = ripley_k_function.latlon_to_cartesian(tgm.lat,tgm.lon) 
-    delta_distance_cartesian = ripley_k_function.convert_distance_to_cartesian_at_point(tgms_training[0].lat, tgms_training[0].lon, cooc.KFUNCTION_DELTA_DISTANCE_KM)
+    points_cartesian = np.array([ripley_k_function.latlon_to_cartesian(tgm.lat,tgm.lon) for tgm in tgms_training])
+    delta_distances_cartesian = np.array([ripley_k_function.convert_distance_to_cartesian_at_point(tgms_training[0].lat, tgms_training[0].lon, delta_distance_km) for delta_distance_km in delta_distances_km])
+    if cooc.APPLY_EDGE_CORRECTION:
+        edge_correction_multipliers = np.column_stack([ripley_k_function.get_edge_correction_multipliers(grid, points_cartesian, delta_distance_cartesian) for delta_distance_cartesian in delta_distances_cartesian])
+    else:
+        edge_correction_multipliers = np.ones((len(tgms_training), len(delta_distances_cartesian)))
+    shared_analysis_data = (tokens_dictionary, tokens_list, tokens_index, bigrams_index, points_cartesian, edge_correction_multipliers, delta_distances_cartesian, area)
 
-    f = open(data.kscore_analysis_file, "w")
-    counter = 0
-    for token_primary in tokens_list:
-        counter += 1
-        logging.debug("Analyzing relationships for primary_token: " + token_primary + " (" + str(counter) + "/" + str(len(tokens_list)) + ")")
-        kScoreAnalyses = ripley_k_function.analyze_relationships_of_token(grid, tokens_dictionary, tgms_training, sparse_rowArr, sparse_colArr, token_primary, delta_distance_cartesian, area)
+    f, f_progress, completed_tokens = open_kscore_analysis_files(resume, delta_distances_km)
+    tokens_to_analyze = [token_primary for token_primary in tokens_list if token_primary not in completed_tokens]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        # imap returns the analyses in the order of tokens_to_analyze, so the output is the same as in a serial run
+        kScoreAnalysesOfTokens = pool.imap(analyze_relationships_of_shared_token, tokens_to_analyze)
+    else:
+        kScoreAnalysesOfTokens = (analyze_relationships_of_shared_token(token_primary) for token_primary in tokens_to_analyze)
+
+    lines_to_append = []
+    tokens_to_checkpoint = []
+    n_analyses, n_simulations = 0, 0
+    for i, kScoreAnalyses in enumerate(kScoreAnalysesOfTokens):
+        token_primary = tokens_to_analyze[i]
+        logging.debug("Analyzed relationships for primary_token: " + token_primary + " (" + str(len(completed_tokens) + i + 1) + "/" + str(len(tokens_list)) + ")")
+        lines_of_token = []
         for kScoreAnalysis in kScoreAnalyses:
             logging.debug(kScoreAnalysis)
-            f.write(kScoreAnalysis.token_primary.encode('utf-8') + "\t" + kScoreAnalysis.token_pair.encode('utf-8') + "\t" + str(kScoreAnalysis.relationship) + "\t" + str(kScoreAnalysis.kscore) + "\n")
-            f.flush()
+            n_analyses += 1
+            n_simulations += kScoreAnalysis.n_simulations
+            additional_columns = "".join("\t" + str(relationship) + "\t" + str(kscore) for relationship, kscore in kScoreAnalysis.additional_analyses)
+            lines_of_token.append(kScoreAnalysis.token_primary.encode('utf-8') + "\t" + kScoreAnalysis.token_pair.encode('utf-8') + "\t" + str(kScoreAnalysis.relationship) + "\t" + str(kScoreAnalysis.kscore) + additional_columns + "\n")
+        lines_to_append.append("".join(lines_of_token))
+        tokens_to_checkpoint.append(token_primary)
+        if len(tokens_to_checkpoint) >= cooc.CHECKPOINT_INTERVAL_TOKENS:
+            append_checkpoint(f, f_progress, lines_to_append, tokens_to_checkpoint)
+            lines_to_append = []
+            tokens_to_checkpoint = []
+    append_checkpoint(f, f_progress, lines_to_append, tokens_to_checkpoint)
     f.close()
+    if cooc.SEQUENTIAL_MONTE_CARLO and n_analyses > 0:
+        n_simulations_saved = n_analyses * cooc.N_MONTE_CARLO_SIMULATIONS - n_simulations
+        logging.info("Sequential Monte Carlo ran " + str(n_simulations) + " simulations for " + str(n_analyses) + " bigrams, saving " + str(n_simulations_saved) + " simulations (" + str(100.0 * n_simulations_saved / (n_analyses * cooc.N_MONTE_CARLO_SIMULATIONS)) + "%)")
+    f_progress.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    shared_analysis_data = None
+
+def open_kscore_analysis_files(resume, delta_distances_km):
+    # The first line of the progress file has the distances of the run, since the lines of runs with different distances have different columns.
+    progress_filename = data.kscore_analysis_file + PROGRESS_FILE_SUFFIX
+    if resume and os.path.exists(data.kscore_analysis_file) and os.path.exists(progress_filename):
+        completed_tokens, kscore_analysis_size, progress_size, delta_distances_km_of_progress = datareader.read_kscore_analysis_progress(progress_filename)
+        if delta_distances_km_of_progress is None and len(completed_tokens) > 0:
+            raise ValueError("Cannot resume from " + progress_filename + ", which does not record the distances of its run")
+        if delta_distances_km_of_progress is not None and delta_distances_km_of_progress != [float(distance_km) for distance_km in delta_distances_km]:
+            raise ValueError("Cannot resume from " + progress_filename + " with the distances " + str(delta_distances_km_of_progress) + " using the distances " + str(delta_distances_km))
+        # anything written after the last checkpoint is discarded, and its tokens are analyzed again
+        f = open(data.kscore_analysis_file, "ab")
+        f.truncate(kscore_analysis_size)
+        f_progress = open(progress_filename, "ab")
+        f_progress.truncate(progress_size)
+        if delta_distances_km_of_progress is None:
+            write_progress_header(f_progress, delta_distances_km)
+        logging.info("Resuming from " + progress_filename + " with " + str(len(completed_tokens)) + " completed primary tokens")
+        return f, f_progress, completed_tokens
+    f_progress = open(progress_filename, "wb")
+    write_progress_header(f_progress, delta_distances_km)
+    return open(data.kscore_analysis_file, "wb"), f_progress, set()
+
+def write_progress_header(f_progress, delta_distances_km):
+    # the header starts with a tab, which does not start the line of a token
+    f_progress.write("\t" + " ".join(repr(float(distance_km)) for distance_km in delta_distances_km) + "\n")
+    f_progress.flush()
+    os.fsync(f_progress.fileno())
 
-def get_sparse_feature_matrix(tokens_dictionary, tgms):
-    rowArr = []
-    colArr = []
-    tweetCounter = 0
-    for tgm in tgms:
-        unique_tokens_in_tweet = []
-        for token in tgm.tokens:
-            if token not in unique_tokens_in_tweet:
-                unique_tokens_in_tweet.append(token)
-        for tokenInTweet in unique_tokens_in_tweet:
-            rowArr.append(tweetCounter)
-            tokenIndex = tokens_dictionary[tokenInTweet]
-            colArr.append(tokenIndex)
-        tweetCounter += 1
-    rowArr = np.array(rowArr)
-    colArr = np.array(colArr)
-    return rowArr, colArr
+def append_checkpoint(f, f_progress, lines_to_append, tokens_to_checkpoint):
+    # lines_to_append[i] holds the lines of tokens_to_checkpoint[i]. The progress line of each token has the size of the output up to its own lines, 
+    # so the output can be truncated to match any number of progress lines written before an interruption.
+    if len(tokens_to_checkpoint) == 0:
+        return
+    f.write("".join(lines_to_append))
+    f.flush()
+    os.fsync(f.fileno())
+    kscore_analysis_sizes = f.tell() - sum(len(lines) for lines in lines_to_append) + np.cumsum([len(lines) for lines in lines_to_append])
+    f_progress.write("".join(token.encode('utf-8') + "\t" + str(kscore_analysis_size) + "\n" for token, kscore_analysis_size in zip(tokens_to_checkpoint, kscore_analysis_sizes.tolist())))
+    f_progress.flush()
+    os.fsync(f_progress.fileno())
 
+def analyze_relationships_of_shared_token(token_primary):
+    tokens_dictionary, tokens_list, tokens_index, bigrams_index, points_cartesian, edge_correction_multipliers, delta_distances_cartesian, area = shared_analysis_data
+    return ripley_k_function.analyze_relationships_of_token(tokens_list, tokens_index, bigrams_index, tokens_dictionary[token_primary], points_cartesian, edge_correction_multipliers, delta_distances_cartesian, area)
 
 def get_grid_area(grid):
-    grid_latmin, grid_lonmin = grid[0].latmin, grid[0].lonmin
-    grid_latmax, grid_lonmax = grid[-1].latmax, grid[-1].lonmax
+    grid_latmin, grid_lonmin = grid.latmin, grid.lonmin
+    grid_latmax, grid_lonmax = grid.latmax, grid.lonmax
     x_distance = float(great_circle((grid_latmin, grid_lonmin), (grid_latmin, grid_lonmax)).kilometers)
     y_distance = float(great_circle((grid_latmin, grid_lonmin), (grid_latmax, grid_lonmin)).kilometers)
     initial_area = x_distance * y_distance
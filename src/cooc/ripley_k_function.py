@@ -10,78 +10,142 @@ import logging
 from scipy import spatial
 from geopy.distance import VincentyDistance
 from math import sqrt
-import random
 import geopy
-import operator
 import cooc
 from math import sin, cos, radians
 import math
-from shapely.geometry import box
 from data import datamodel
-from _collections import defaultdict
 
 bearing_north = 0.0
 bearing_east = 90.0
 bearing_south = 180.0
 bearing_west = 270.0
 
-def analyze_relationships_of_token(grid, tokens_dictionary, tgms_training, sparse_rowArr, sparse_colArr, token_primary, delta_distance_cartesian, area):
+# Upper bound for the number of random keys or positions drawn at once for the samples of Monte Carlo simulations
+MAX_RANDOM_KEYS_IN_BATCH = 2**22
+# Samples are drawn as random positions if the population is at least this many times the sample, and by random keys of the population otherwise
+MIN_POPULATION_TO_SAMPLE_RATIO = 4
+
+def analyze_relationships_of_token(tokens_list, tokens_index, bigrams_index, token_id_primary, points_cartesian, edge_correction_multipliers, delta_distances_cartesian, area):
     kScoreAnalyses = []
-    tgm_indices_primary = get_tgm_indices_with_token(sparse_rowArr, sparse_colArr, tokens_dictionary[token_primary])
-    tgms_primary = [tgms_training[tgm_index] for tgm_index in tgm_indices_primary]
-    cooccurrence_counts, cooccurring_tgms_with_tokens = get_ordered_cooccurrences_of_token(token_primary, tgms_primary)
-    sorted_cooccurrence_counts = sorted(cooccurrence_counts.items(), key=operator.itemgetter(1), reverse=True)
-    for cooccurrence in sorted_cooccurrence_counts:
-        if cooccurrence[1] < cooc.MIN_TERM_FREQUENCY:
-            break
-        tgms_cooccurring = cooccurring_tgms_with_tokens[cooccurrence[0]]
-        logging.debug("Analyzing " + token_primary + " (freq:" + str(len(tgms_primary)) + ") and " + cooccurrence[0] + " (freq:" + str(cooccurrence[1]) + ") cooccurring " + str(len(tgms_cooccurring)) + " times") 
-        kScoreOfCooccurrence, kScoresOfSimulations = execute_montecarlo(grid, tgms_primary, tgms_cooccurring, delta_distance_cartesian, area)
-        kScoreAnalysis = analyze_significance_of_kvalues(token_primary, cooccurrence[0], kScoreOfCooccurrence, kScoresOfSimulations)
+    tgm_indices_primary = tokens_index.get_tgm_indices_with_token_id(token_id_primary)
+    points_cartesian_primary = points_cartesian[tgm_indices_primary]
+    edge_correction_multipliers_primary = edge_correction_multipliers[tgm_indices_primary]
+    for bigram_id in bigrams_index.get_bigram_ids_of_token_id(token_id_primary):
+        token_id_left, token_id_right = bigrams_index.token_ids_left[bigram_id], bigrams_index.token_ids_right[bigram_id]
+        # the tweets of a bigram are a subset of the tweets of its tokens, and both are sorted
+        positions_cooccurring = np.searchsorted(tgm_indices_primary, bigrams_index.get_tgm_indices_of_bigram_id(bigram_id))
+        seed = get_seed_of_token_pair(token_id_primary, token_id_left, token_id_right, len(tokens_list))
+        token_pair = tokens_list[token_id_left] + cooc.STR_SEPARATOR_FOR_BIGRAMS + tokens_list[token_id_right]
+        logging.debug("Analyzing " + tokens_list[token_id_primary] + " (freq:" + str(len(tgm_indices_primary)) + ") and " + token_pair + " cooccurring " + str(len(positions_cooccurring)) + " times") 
+        kScoresOfCooccurrence, kScoresOfSimulations = execute_montecarlo(points_cartesian_primary, edge_correction_multipliers_primary, positions_cooccurring, seed, delta_distances_cartesian, area)
+        kScoreAnalysis = analyze_significance_of_kvalues(tokens_list[token_id_primary], token_pair, kScoresOfCooccurrence, kScoresOfSimulations)
         kScoreAnalyses.append(kScoreAnalysis)
     return kScoreAnalyses
 
-def analyze_significance_of_kvalues(token_primary, token_pair, kScoreOfCooccurrence, kScoresOfSimulations):
-    kScoresOfSimulations.sort(reverse=True)
-    envelope_size = int( cooc.SIGNIFICANCE_RANGE * cooc.N_MONTE_CARLO_SIMULATIONS)
-    envelope_upper_boundary = kScoresOfSimulations[envelope_size-1]
-    envelope_lower_boundary = kScoresOfSimulations[-envelope_size]
-    if kScoreOfCooccurrence < envelope_lower_boundary:
-        relationship = cooc.Relationship.REPULSION
-    elif kScoreOfCooccurrence > envelope_upper_boundary:
-        relationship = cooc.Relationship.ATTRACTION
-    else:
-        relationship = cooc.Relationship.NOTHING_SIGNIFICANT
-    kScoreAnalysis = datamodel.KScoreAnalysis(token_primary, token_pair, relationship, kScoreOfCooccurrence)
+def analyze_significance_of_kvalues(token_primary, token_pair, kScoresOfCooccurrence, kScoresOfSimulations):
+    # The kscore is below the lower boundary of the envelope (the envelope_size-th smallest simulation) iff fewer than envelope_size simulations are <= kscore,
+    # and above the upper boundary (the envelope_size-th largest simulation) iff fewer than envelope_size simulations are >= kscore.
+    # Columns of kScoresOfSimulations correspond to the distances in kScoresOfCooccurrence.
+    kScoresOfSimulations = np.asarray(kScoresOfSimulations).reshape(-1, len(kScoresOfCooccurrence))
+    counts_less_or_equal = np.sum(kScoresOfSimulations <= kScoresOfCooccurrence, axis=0)
+    counts_greater_or_equal = np.sum(kScoresOfSimulations >= kScoresOfCooccurrence, axis=0)
+    envelope_size = get_envelope_size()
+    relationships = []
+    for count_less_or_equal, count_greater_or_equal in zip(counts_less_or_equal, counts_greater_or_equal):
+        if count_less_or_equal < envelope_size:
+            relationships.append(cooc.Relationship.REPULSION)
+        elif count_greater_or_equal < envelope_size:
+            relationships.append(cooc.Relationship.ATTRACTION)
+        else:
+            relationships.append(cooc.Relationship.NOTHING_SIGNIFICANT)
+    kscores = [float(kScoreOfCooccurrence) for kScoreOfCooccurrence in kScoresOfCooccurrence]
+    kScoreAnalysis = datamodel.KScoreAnalysis(token_primary, token_pair, relationships[0], kscores[0], len(kScoresOfSimulations), zip(relationships[1:], kscores[1:]))
     return kScoreAnalysis
 
-def execute_montecarlo(grid, tgms_primary, tgms_cooccurring, delta_distance_cartesian, area):
-    points_cartesian_cooccur = [tgm.cartesian_coordinates for tgm in tgms_cooccurring]
-    kScoreOfCooccurrence = k_function_cartesian(grid, points_cartesian_cooccur, delta_distance_cartesian, area, cooc.APPLY_EDGE_CORRECTION)
+def get_envelope_size():
+    return int( cooc.SIGNIFICANCE_RANGE * cooc.N_MONTE_CARLO_SIMULATIONS)
+
+def is_significance_decided(counts_less_or_equal, counts_greater_or_equal, remaining_simulations, envelope_size):
+    is_nothing_significant = (counts_less_or_equal >= envelope_size) & (counts_greater_or_equal >= envelope_size)
+    is_significant = (counts_less_or_equal + remaining_simulations < envelope_size) | (counts_greater_or_equal + remaining_simulations < envelope_size)
+    return np.all(is_nothing_significant | is_significant)
+
+def execute_montecarlo(points_cartesian_primary, edge_correction_multipliers_primary, positions_cooccurring, seed, delta_distances_cartesian, area):
+    kScoresOfCooccurrence = k_function_cartesian(points_cartesian_primary[positions_cooccurring], edge_correction_multipliers_primary[positions_cooccurring], delta_distances_cartesian, area)
     
-    random.seed(len(tgms_primary) * len(tgms_cooccurring))
-    points_cartesian_primary = [tgm.cartesian_coordinates for tgm in tgms_primary]
+    random_state = np.random.RandomState(seed)
+    random_samples = generate_random_samples(random_state, len(points_cartesian_primary), len(positions_cooccurring), cooc.N_MONTE_CARLO_SIMULATIONS)
     
     kScoresOfSimulations = []
-    for _ in range(cooc.N_MONTE_CARLO_SIMULATIONS):
-        latlons_primary3D_random_sample = random.sample(points_cartesian_primary, len(tgms_cooccurring))
-        kScoreOfSimulation = k_function_cartesian(grid, latlons_primary3D_random_sample, delta_distance_cartesian, area, cooc.APPLY_EDGE_CORRECTION)
-        kScoresOfSimulations.append(kScoreOfSimulation)
-    return kScoreOfCooccurrence, kScoresOfSimulations
+    envelope_size = get_envelope_size()
+    counts_less_or_equal, counts_greater_or_equal = 0, 0
+    for i, positions_random_sample in enumerate(random_samples):
+        kScoresOfSimulation = k_function_cartesian(points_cartesian_primary[positions_random_sample], edge_correction_multipliers_primary[positions_random_sample], delta_distances_cartesian, area)
+        kScoresOfSimulations.append(kScoresOfSimulation)
+        if cooc.SEQUENTIAL_MONTE_CARLO:
+            counts_less_or_equal += kScoresOfSimulation <= kScoresOfCooccurrence
+            counts_greater_or_equal += kScoresOfSimulation >= kScoresOfCooccurrence
+            if is_significance_decided(counts_less_or_equal, counts_greater_or_equal, cooc.N_MONTE_CARLO_SIMULATIONS - i - 1, envelope_size):
+                break
+    return kScoresOfCooccurrence, kScoresOfSimulations
     
-def k_function_cartesian(grid, points_cartesian, delta_distance_cartesian, area, apply_edge_correction):
+def generate_random_samples(random_state, population_size, sample_size, n_samples):
+    # Small samples are drawn as random positions, and the positions drawn more than once in a sample are drawn again.
+    # Large samples are the positions of the sample_size smallest keys in a row of random keys, which is a random permutation of the population.
+    # The samples are drawn in batches of rows to bound the memory for large populations.
+    if sample_size * MIN_POPULATION_TO_SAMPLE_RATIO <= population_size:
+        batch_size = max(1, MAX_RANDOM_KEYS_IN_BATCH // max(1, sample_size))
+        for batch_start in range(0, n_samples, batch_size):
+            random_positions = random_state.randint(population_size, size=(min(batch_size, n_samples - batch_start), sample_size))
+            for positions_random_sample in redraw_duplicate_positions(random_state, random_positions, population_size):
+                yield positions_random_sample
+        return
+    batch_size = max(1, MAX_RANDOM_KEYS_IN_BATCH // population_size)
+    for batch_start in range(0, n_samples, batch_size):
+        random_keys = random_state.random_sample((min(batch_size, n_samples - batch_start), population_size))
+        for positions_random_sample in np.argpartition(random_keys, sample_size - 1, axis=1)[:, :sample_size]:
+            yield positions_random_sample
+
+def redraw_duplicate_positions(random_state, random_positions, population_size):
+    # Redrawing does not prefer any position of the population, so each row becomes a sample without replacement.
+    while True:
+        random_positions.sort(axis=1)
+        is_duplicate = np.zeros(random_positions.shape, dtype=bool)
+        is_duplicate[:, 1:] = random_positions[:, 1:] == random_positions[:, :-1]
+        n_duplicates = np.count_nonzero(is_duplicate)
+        if n_duplicates == 0:
+            return random_positions
+        random_positions[is_duplicate] = random_state.randint(population_size, size=n_duplicates)
+
+def get_seed_of_token_pair(token_id_primary, token_id_left, token_id_right, number_of_tokens):
+    return ((token_id_primary * number_of_tokens + token_id_left) * number_of_tokens + token_id_right) % (2**32)
+
+def k_function_cartesian(points_cartesian, edge_correction_multipliers, delta_distances_cartesian, area):
+    # Returns the kscores for all distances in delta_distances_cartesian, using the same tree.
+    # Columns of edge_correction_multipliers correspond to the distances.
     number_of_points = len(points_cartesian)
-    count_in_range = [0] * number_of_points
     kdTree = spatial.cKDTree(points_cartesian)
-    for i in range(number_of_points):
-        if apply_edge_correction:
-            ratio_of_circle_in_grid = get_ratio_of_circle_in_grid(grid, points_cartesian[i], delta_distance_cartesian)
-            edge_correction_multiplier = 1.0 / ratio_of_circle_in_grid
-        else:
-            edge_correction_multiplier = 1.0
-        points_in_range = kdTree.query_ball_point([points_cartesian[i][0], points_cartesian[i][1], points_cartesian[i][2]], r = delta_distance_cartesian)
-        count_in_range[i] = edge_correction_multiplier * (len(points_in_range) - 1)
-    return float(area * sum(count_in_range)) / (number_of_points**2)
+    counts_in_ranges = edge_correction_multipliers * count_neighbors_in_ranges(kdTree, points_cartesian, delta_distances_cartesian)
+    # cumsum adds the counts sequentially, which keeps the result identical to summing them point by point
+    return area * np.cumsum(counts_in_ranges, axis=0)[-1] / (number_of_points**2)
+
+def count_neighbors_in_ranges(kdTree, points_cartesian, delta_distances_cartesian):
+    # return_length is available in scipy >= 1.3, older versions count the pairs in the largest range and select the pairs for the smaller ranges by their distances
+    try:
+        return np.column_stack([kdTree.query_ball_point(points_cartesian, r = delta_distance_cartesian, return_length = True) - 1 for delta_distance_cartesian in delta_distances_cartesian])
+    except TypeError:
+        max_delta_distance_cartesian = max(delta_distances_cartesian)
+        pairs_in_range = kdTree.query_pairs(max_delta_distance_cartesian, output_type = 'ndarray')
+        squared_distances_of_pairs = np.sum((points_cartesian[pairs_in_range[:, 0]] - points_cartesian[pairs_in_range[:, 1]])**2, axis=1)
+        counts_in_ranges = []
+        for delta_distance_cartesian in delta_distances_cartesian:
+            if delta_distance_cartesian < max_delta_distance_cartesian:
+                pairs_in_range_of_distance = pairs_in_range[squared_distances_of_pairs <= delta_distance_cartesian**2]
+            else:
+                pairs_in_range_of_distance = pairs_in_range
+            counts_in_ranges.append(np.bincount(pairs_in_range_of_distance.ravel(), minlength = len(points_cartesian)))
+        return np.column_stack(counts_in_ranges)
 
 def convert_distance_to_cartesian_at_point(lat, lon, delta_distance_km):
     point_cartesian = latlon_to_cartesian(lat,lon)
@@ -102,19 +166,24 @@ def cartesian_to_latlon(x, y, z):
     lon = math.degrees(math.atan2(y, x))
     return lat, lon
 
-def get_ratio_of_circle_in_grid(grid, circle_latlon3D, distance_range3D):
-    grid_latmin, grid_lonmin = grid[0].latmin, grid[0].lonmin
-    grid_latmax, grid_lonmax = grid[-1].latmax, grid[-1].lonmax
+def get_edge_correction_multipliers(grid, points_cartesian, distance_range3D):
+    ratios_of_circles_in_grid = get_ratios_of_circles_in_grid(grid, points_cartesian, distance_range3D)
+    return 1.0 / ratios_of_circles_in_grid
+
+def get_ratios_of_circles_in_grid(grid, circles_latlon3D, distance_range3D):
+    grid_latmin, grid_lonmin = grid.latmin, grid.lonmin
+    grid_latmax, grid_lonmax = grid.latmax, grid.lonmax
     grid_sw3D = latlon_to_cartesian(grid_latmin, grid_lonmin)
     grid_ne3D = latlon_to_cartesian(grid_latmax, grid_lonmax)
-    if (math.fabs(circle_latlon3D[0] - grid_sw3D[0]) < distance_range3D) or (math.fabs(grid_ne3D[0] - circle_latlon3D[0]) < distance_range3D) or \
-        (math.fabs(circle_latlon3D[1] - grid_sw3D[1]) < distance_range3D) or (math.fabs(grid_ne3D[1] - circle_latlon3D[1]) < distance_range3D):
-        grid_box = box(grid_sw3D[0], grid_sw3D[1], grid_ne3D[0], grid_ne3D[1])
-        circle_region = box(circle_latlon3D[0] - distance_range3D, circle_latlon3D[1] - distance_range3D, circle_latlon3D[0] + distance_range3D, circle_latlon3D[1] + distance_range3D) 
-        intersection_area = grid_box.intersection(circle_region).area
-        circle_area = circle_region.area
-        return intersection_area / circle_area
-    return 1.0
+    circles_x, circles_y = circles_latlon3D[:, 0], circles_latlon3D[:, 1]
+    close_to_edge = (np.fabs(circles_x - grid_sw3D[0]) < distance_range3D) | (np.fabs(grid_ne3D[0] - circles_x) < distance_range3D) | \
+        (np.fabs(circles_y - grid_sw3D[1]) < distance_range3D) | (np.fabs(grid_ne3D[1] - circles_y) < distance_range3D)
+    grid_xmin, grid_xmax = min(grid_sw3D[0], grid_ne3D[0]), max(grid_sw3D[0], grid_ne3D[0])
+    grid_ymin, grid_ymax = min(grid_sw3D[1], grid_ne3D[1]), max(grid_sw3D[1], grid_ne3D[1])
+    intersection_width = np.clip(np.minimum(grid_xmax, circles_x + distance_range3D) - np.maximum(grid_xmin, circles_x - distance_range3D), 0.0, None)
+    intersection_height = np.clip(np.minimum(grid_ymax, circles_y + distance_range3D) - np.maximum(grid_ymin, circles_y - distance_range3D), 0.0, None)
+    circle_area = (2.0 * distance_range3D) ** 2
+    return np.where(close_to_edge, intersection_width * intersection_height / circle_area, 1.0)
 
 def latlon_to_cartesian(lat, lon):
     R = np.float64(6371.000)
@@ -123,33 +192,3 @@ def latlon_to_cartesian(lat, lon):
     y = R * cos(latitude) * sin(longitude)
     z = R * sin(latitude)
     return x, y, z
-
-def get_ordered_cooccurrences_of_token(token_primary, tgms_of_token):
-    cooccurrence_counts_of_token = defaultdict(int)
-    cooccurring_tgms_of_token = defaultdict(list)
-    for tgm in tgms_of_token:
-        token_indices_primary = [token_index for token_index, token in enumerate(tgm.tokens) if token == token_primary]
-        found_token_pairs_in_tgm = set()
-        for token_index_primary in token_indices_primary:
-            token_index_secondary = token_index_primary + 1
-            if token_index_secondary < len(tgm.tokens):
-                token_secondary = tgm.tokens[token_index_secondary]
-                token_pair = token_primary + cooc.STR_SEPARATOR_FOR_BIGRAMS + token_secondary 
-                if token_pair not in found_token_pairs_in_tgm:
-                    cooccurrence_counts_of_token[token_pair] += 1
-                    cooccurring_tgms_of_token[token_pair].append(tgm)
-                    found_token_pairs_in_tgm.add(token_pair)
-            token_index_secondary = token_index_primary - 1
-            if token_index_secondary >= 0:
-                token_secondary = tgm.tokens[token_index_secondary] 
-                token_pair = token_secondary + cooc.STR_SEPARATOR_FOR_BIGRAMS + token_primary
-                if token_pair not in found_token_pairs_in_tgm:
-                    cooccurrence_counts_of_token[token_pair] += 1
-                    cooccurring_tgms_of_token[token_pair].append(tgm)
-                    found_token_pairs_in_tgm.add(token_pair)
-    return cooccurrence_counts_of_token, cooccurring_tgms_of_token
-
-def get_tgm_indices_with_token(sparse_rowArr, sparse_colArr, token_id):    
-    row_indexes_with_feature = np.nonzero(sparse_colArr == token_id)
-    tgm_indices = sparse_rowArr[row_indexes_with_feature]
-    return tgm_indices
@@ -31,4 +31,19 @@ grid_file = '/path/to/grid_definition_file'
 This file will be generated by the application.
 cooc.main_cooc.py writes the co-occurrence analysis results into this file, which is then used in classification.
 '''
-kscore_analysis_file = '/path/to/kscore_analysis_file'
\ No newline at end of file
+kscore_analysis_file = '/path/to/kscore_analysis_file'
+'''
+Directory of the disk cache for the probabilities of grid cells computed for tokens in prediction.classifier.KDESum. 
+The probabilities of a token are reused if its observations, bandwidth and the grid are unchanged. None disables the cache.
+'''
+kde_cache_directory = None
+'''
+Directory of the binary cache for the training, test and grid files read by data.datareader. 
+A file is parsed once, and later runs memory-map its cached arrays while the file is unchanged. None disables the cache.
+'''
+corpus_cache_directory = None
+'''
+If True, the grid cells of training and test tweets in prediction.main_prediction are found from their coordinates using the grid at grid_file, 
+and the tweets outside the grid are skipped. The first columns of the training and test files are then ignored.
+'''
+assign_gridcells = False
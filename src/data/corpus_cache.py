@@ -0,0 +1,131 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: This file includes the functions of a binary cache for the tweet and grid files read by data.datareader.
+The columns of a file are stored in .npy files in a directory of the cache, together with the vocabulary of tweets and a fingerprint of the file.
+The arrays are memory-mapped when the fingerprint matches the file, so the text of the file is not parsed again.
+A file is fresh if its size and modification time are unchanged, or if its size and SHA-1 are unchanged.
+The fingerprint is taken before the file is parsed, so a file that changes while it is parsed is not fresh in the next run.
+'''
+
+import hashlib
+import logging
+import os
+import shutil
+import numpy as np
+from data.datamodel import TweetCorpus, GridCell
+
+CORPUS_ARRAYS = ['gcids', 'lats', 'lons', 'token_ids', 'token_offsets']
+GRID_ARRAYS = ['gcids', 'latmins', 'lonmins', 'latmaxs', 'lonmaxs']
+TOKENS_FILE = 'tokens.txt'
+FINGERPRINT_FILE = 'fingerprint.txt'
+
+def load_corpus(cache_directory, filename, mmap_mode='r'):
+    arrays = load_arrays(cache_directory, filename, CORPUS_ARRAYS, mmap_mode)
+    if arrays is None:
+        return None
+    infile = open(os.path.join(get_directory(cache_directory, filename), TOKENS_FILE), "rb")
+    tokens_list = [unicode(line.rstrip('\n'), 'utf-8') for line in infile]
+    infile.close()
+    return TweetCorpus(*(arrays + [tokens_list]))
+
+def save_corpus(cache_directory, filename, corpus, fingerprint):
+    save_arrays(cache_directory, filename, CORPUS_ARRAYS, [corpus.gcids, corpus.lats, corpus.lons, corpus.token_ids, corpus.token_offsets], fingerprint, corpus.tokens_list)
+
+def load_grid(cache_directory, filename):
+    arrays = load_arrays(cache_directory, filename, GRID_ARRAYS, None)
+    if arrays is None:
+        return None
+    return [GridCell(*fields) for fields in zip(*[array.tolist() for array in arrays])]
+
+def save_grid(cache_directory, filename, gridcells, fingerprint):
+    arrays = [np.array([gc.gcid for gc in gridcells], dtype=int), np.array([gc.latmin for gc in gridcells], dtype=np.float64), np.array([gc.lonmin for gc in gridcells], dtype=np.float64), 
+              np.array([gc.latmax for gc in gridcells], dtype=np.float64), np.array([gc.lonmax for gc in gridcells], dtype=np.float64)]
+    save_arrays(cache_directory, filename, GRID_ARRAYS, arrays, fingerprint)
+
+def get_directory(cache_directory, filename):
+    # files with the same name in different directories are cached separately
+    return os.path.join(cache_directory, os.path.basename(filename) + "-" + hashlib.sha1(os.path.abspath(filename)).hexdigest()[:16])
+
+def load_arrays(cache_directory, filename, names, mmap_mode):
+    directory = get_directory(cache_directory, filename)
+    fingerprint = read_fingerprint(directory)
+    if fingerprint is None:
+        return None
+    size, mtime, sha1 = fingerprint
+    file_size, file_mtime = get_size_and_mtime(filename)
+    if size != file_size:
+        return None
+    if mtime != file_mtime:
+        if sha1 != get_sha1(filename):
+            return None
+        # the file was touched without changing its content
+        file_size, file_mtime = get_size_and_mtime(filename)
+        write_fingerprint(directory, (file_size, file_mtime, sha1))
+    try:
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in names]
+    except (IOError, ValueError):
+        logging.warning("Could not read the cache of " + filename + " at " + directory)
+        return None
+    logging.debug("Read " + filename + " from the cache at " + directory)
+    return arrays
+
+def save_arrays(cache_directory, filename, names, arrays, fingerprint, tokens_list=None):
+    # The arrays are written to a temporary directory that replaces the previous cache of the file, 
+    # so the processes reading the previous cache do not see a partially written one.
+    directory = get_directory(cache_directory, filename)
+    temporary_directory = directory + "." + str(os.getpid()) + ".tmp"
+    if os.path.exists(temporary_directory):
+        shutil.rmtree(temporary_directory)
+    os.makedirs(temporary_directory)
+    for name, array in zip(names, arrays):
+        np.save(os.path.join(temporary_directory, name + '.npy'), array)
+    if tokens_list is not None:
+        outfile = open(os.path.join(temporary_directory, TOKENS_FILE), "wb")
+        outfile.write("".join(token.encode('utf-8') + "\n" for token in tokens_list))
+        outfile.close()
+    write_fingerprint(temporary_directory, fingerprint)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(temporary_directory, directory)
+    logging.debug("Saved " + filename + " to the cache at " + directory)
+
+def get_fingerprint(filename):
+    # The SHA-1 is calculated first, so a change of the file after it also changes the size or the modification time.
+    sha1 = get_sha1(filename)
+    size, mtime = get_size_and_mtime(filename)
+    return size, mtime, sha1
+
+def read_fingerprint(directory):
+    # a missing or malformed fingerprint is a cache miss
+    try:
+        infile = open(os.path.join(directory, FINGERPRINT_FILE), "rb")
+        fields = infile.read().split('\t')
+        infile.close()
+        if len(fields) != 3 or len(fields[2]) != hashlib.sha1().digest_size * 2:
+            return None
+        return int(fields[0]), fields[1], fields[2]
+    except (IOError, ValueError, IndexError):
+        return None
+
+def write_fingerprint(directory, fingerprint):
+    # the fingerprint replaces the previous one at once, so an interrupted write does not leave a truncated fingerprint
+    size, mtime, sha1 = fingerprint
+    temporary_path = os.path.join(directory, FINGERPRINT_FILE + "." + str(os.getpid()) + ".tmp")
+    outfile = open(temporary_path, "wb")
+    outfile.write(str(size) + "\t" + mtime + "\t" + sha1)
+    outfile.close()
+    os.rename(temporary_path, os.path.join(directory, FINGERPRINT_FILE))
+
+def get_size_and_mtime(filename):
+    stat = os.stat(filename)
+    return stat.st_size, repr(stat.st_mtime)
+
+def get_sha1(filename):
+    sha1 = hashlib.sha1()
+    infile = open(filename, "rb")
+    for block in iter(lambda: infile.read(2**20), ""):
+        sha1.update(block)
+    infile.close()
+    return sha1.hexdigest()
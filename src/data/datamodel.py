@@ -3,9 +3,14 @@
 @license:  See 'LICENSE.md' as part of this package.
 @precondition:
 @summary: Definition of data models that represent entries in input files. 
+TweetCorpus stores the tweets of a file in flat arrays, and returns them as TweetGridMap instances when they are accessed.
 '''
 
-class TweetGridMap:
+TWEET_VIEW_CHUNK_SIZE = 10000
+
+class TweetGridMap(object):
+    __slots__ = ('gcid', 'lat', 'lon', 'tokens', 'cartesian_coordinates')
+
     def __init__(self, gcid, lat, lon, tokens):
         self.gcid = gcid
         self.lat = lat
@@ -18,6 +23,50 @@ class TweetGridMap:
     
     __repr__ = __str__
 
+class TweetCorpus(object):
+    def __init__(self, gcids, lats, lons, token_ids, token_offsets, tokens_list):
+        # The token ids of tweet i are token_ids[token_offsets[i]:token_offsets[i+1]], in the order of its tokens in the file.
+        self.gcids = gcids
+        self.lats = lats
+        self.lons = lons
+        self.token_ids = token_ids
+        self.token_offsets = token_offsets
+        self.tokens_list = tokens_list
+        self.tokens_dictionary = dict((token, i) for i, token in enumerate(tokens_list))
+
+    def __len__(self):
+        return len(self.gcids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            return self.get_tweet_grid_maps(start, stop)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("tweet index out of range")
+        return TweetGridMap(int(self.gcids[index]), float(self.lats[index]), float(self.lons[index]), self.get_tokens(index))
+
+    def __iter__(self):
+        for chunk_start in xrange(0, len(self), TWEET_VIEW_CHUNK_SIZE):
+            for tgm in self.get_tweet_grid_maps(chunk_start, min(chunk_start + TWEET_VIEW_CHUNK_SIZE, len(self))):
+                yield tgm
+
+    def get_tweet_grid_maps(self, start, stop):
+        # the arrays are converted to lists together, which is faster than converting the fields of every tweet
+        token_offsets = (self.token_offsets[start:stop + 1] - self.token_offsets[start]).tolist()
+        token_ids = self.token_ids[self.token_offsets[start]:self.token_offsets[stop]].tolist()
+        tokens_of_tweets = [[self.tokens_list[token_id] for token_id in token_ids[token_offsets[i]:token_offsets[i + 1]]] for i in xrange(stop - start)]
+        return [TweetGridMap(*fields) for fields in zip(self.gcids[start:stop].tolist(), self.lats[start:stop].tolist(), self.lons[start:stop].tolist(), tokens_of_tweets)]
+
+    def get_token_ids(self, index):
+        return self.token_ids[self.token_offsets[index]:self.token_offsets[index + 1]]
+
+    def get_tokens(self, index):
+        return [self.tokens_list[token_id] for token_id in self.get_token_ids(index)]
+
 class GridCell:
     def __init__(self, gcid, latmin, lonmin, latmax, lonmax):
         self.gcid = gcid
@@ -32,11 +81,13 @@ class GridCell:
     __repr__ = __str__
 
 class KScoreAnalysis:
-    def __init__(self, token_primary, token_pair, relationship, kscore):
+    def __init__(self, token_primary, token_pair, relationship, kscore, n_simulations=None, additional_analyses=None):
         self.token_primary = token_primary
         self.token_pair = token_pair
         self.relationship = relationship
         self.kscore = kscore
+        self.n_simulations = n_simulations
+        self.additional_analyses = additional_analyses if additional_analyses is not None else []
       
     def __str__(self):
         return "rel: " + str(self.relationship) + ", primary: " + self.token_primary + ", token_pair: " + self.token_pair + ", kscore: " + str(self.kscore)
@@ -3,29 +3,107 @@
 @license:  See 'LICENSE.md' as part of this package.
 @precondition: files must be available in given paths.
 @summary: This file includes the functions to read grid, tweets and results of co-occurrence pattern analysis from files. 
+Tweet files are read line by line, either in chunks of TweetGridMap instances or into a TweetCorpus, 
+which keeps the tweets in flat arrays instead of an object for each tweet.
+If data.corpus_cache_directory is set, the tweet and grid files are read from their binary cache when it is fresh, and cached after parsing otherwise.
+The grid cells of tweets can be assigned from their coordinates instead of the first column of tweet files.
 '''
 
 import logging
-from data.datamodel import TweetGridMap, GridCell, KScoreAnalysis
+from data.datamodel import TweetGridMap, TweetCorpus, GridCell, KScoreAnalysis
+from data.grid import Grid
 from _collections import defaultdict
+from array import array
+import numpy as np
 import cooc
+import data
+from data import corpus_cache
 
-def readTweetGridMaps(filename):
+TWEET_CHUNK_SIZE = 100000
+
+def readTweetGridMaps(filename, grid=None):
+    # If grid is given, the grid cells of tweets are found from their coordinates, and the tweets outside the grid are skipped.
     logging.debug("Reading tweet grid maps")
-    infile = open(filename, "r")
-    lines = infile.readlines()
-    infile.close()
-    
     tweetGridMaps = []
-    for line in lines:
-        fields = unicode(line, 'utf-8').split('\t')
-        tgm = TweetGridMap(int(fields[0]), float(fields[1]), float(fields[2]), fields[3].split())
-        tweetGridMaps.append(tgm)
+    for tgms_chunk in read_tweet_grid_map_chunks(filename):
+        if grid is not None:
+            tgms_chunk = assign_gridcells(tgms_chunk, grid)
+        tweetGridMaps.extend(tgms_chunk)
     logging.debug("Finished reading " + str(len(tweetGridMaps)) + " tweetgridmaps")
     return tweetGridMaps
 
+def assign_gridcells(tgms, grid):
+    gcids = grid.get_gcids_of_points([tgm.lat for tgm in tgms], [tgm.lon for tgm in tgms])
+    tgms_in_grid = []
+    for tgm, gcid in zip(tgms, gcids.tolist()):
+        if gcid >= 0:
+            tgm.gcid = gcid
+            tgms_in_grid.append(tgm)
+    if len(tgms_in_grid) < len(tgms):
+        logging.debug("Skipped " + str(len(tgms) - len(tgms_in_grid)) + " tweets outside the grid")
+    return tgms_in_grid
+
+def read_tweet_grid_map_chunks(filename, chunk_size=TWEET_CHUNK_SIZE):
+    if data.corpus_cache_directory is not None:
+        corpus = read_tweet_corpus(filename)
+        for chunk_start in xrange(0, len(corpus), chunk_size):
+            yield corpus[chunk_start:chunk_start + chunk_size]
+        return
+    tgms_chunk = []
+    for gcid, lat, lon, tokens in read_tweet_fields(filename):
+        tgms_chunk.append(TweetGridMap(gcid, lat, lon, tokens))
+        if len(tgms_chunk) == chunk_size:
+            yield tgms_chunk
+            tgms_chunk = []
+    if len(tgms_chunk) > 0:
+        yield tgms_chunk
+
+def read_tweet_fields(filename):
+    infile = open(filename, "r")
+    for line in infile:
+        fields = unicode(line, 'utf-8').split('\t')
+        yield int(fields[0]), float(fields[1]), float(fields[2]), fields[3].split()
+    infile.close()
+
+def read_tweet_corpus(filename):
+    # Tokens are interned to ids in the order they are first seen. The arrays grow in place, so the peak memory is close to the size of the arrays.
+    logging.debug("Reading tweet corpus")
+    if data.corpus_cache_directory is not None:
+        corpus = corpus_cache.load_corpus(data.corpus_cache_directory, filename)
+        if corpus is not None:
+            logging.debug("Finished reading " + str(len(corpus)) + " tweets from the cache")
+            return corpus
+    if data.corpus_cache_directory is not None:
+        fingerprint = corpus_cache.get_fingerprint(filename)
+    tokens_dictionary = {}
+    gcids = array('i')
+    lats = array('d')
+    lons = array('d')
+    token_ids = array('i')
+    token_offsets = array('l', [0])
+    for gcid, lat, lon, tokens in read_tweet_fields(filename):
+        gcids.append(gcid)
+        lats.append(lat)
+        lons.append(lon)
+        token_ids.extend([tokens_dictionary.setdefault(token, len(tokens_dictionary)) for token in tokens])
+        token_offsets.append(len(token_ids))
+    tokens_list = [None] * len(tokens_dictionary)
+    for token, token_id in tokens_dictionary.iteritems():
+        tokens_list[token_id] = token
+    corpus = TweetCorpus(np.frombuffer(gcids, dtype=np.int32), np.frombuffer(lats, dtype=np.float64), np.frombuffer(lons, dtype=np.float64), 
+                         np.frombuffer(token_ids, dtype=np.int32), np.frombuffer(token_offsets, dtype='l'), tokens_list)
+    logging.debug("Finished reading " + str(len(corpus)) + " tweets with " + str(len(tokens_list)) + " distinct tokens")
+    if data.corpus_cache_directory is not None:
+        corpus_cache.save_corpus(data.corpus_cache_directory, filename, corpus, fingerprint)
+    return corpus
+
 def readGrid(filename):
     logging.debug("Reading grid")
+    if data.corpus_cache_directory is not None:
+        gridcells = corpus_cache.load_grid(data.corpus_cache_directory, filename)
+        if gridcells is not None:
+            return Grid(gridcells)
+        fingerprint = corpus_cache.get_fingerprint(filename)
     infile = open(filename, "r")
     lines = infile.readlines()
     infile.close()
@@ -36,7 +114,9 @@ def readGrid(filename):
         gc = GridCell(int(fields[0]), float(fields[1]), float(fields[2]), float(fields[3]), float(fields[4]))
         gridcells.append(gc)
     logging.debug("Finished reading " + str(len(gridcells)) + " gridcells")
-    return gridcells
+    if data.corpus_cache_directory is not None:
+        corpus_cache.save_grid(data.corpus_cache_directory, filename, gridcells, fingerprint)
+    return Grid(gridcells)
 
 def read_kscore_token_pairs(filename):
     logging.debug("Reading kscore token pairs")
@@ -57,6 +137,32 @@ def read_kscore_token_pairs(filename):
     logging.debug("There are " + str(len(repulsion_token_pairs_dict)) + " primary tokens with relationship: " + str(cooc.Relationship.REPULSION))
     return attraction_token_pairs_dict, repulsion_token_pairs_dict
 
+def read_kscore_analysis_progress(filename):
+    # Returns the completed tokens, the sizes of the analysis and progress files up to the last completed token, and the distances of the run, 
+    # which are None if the progress file does not start with them.
+    logging.debug("Reading kscore analysis progress")
+    infile = open(filename, "r")
+    lines = infile.readlines()
+    infile.close()
+    
+    completed_tokens = set()
+    kscore_analysis_size = 0
+    progress_size = 0
+    delta_distances_km = None
+    for line in lines:
+        if not line.endswith("\n"):
+            break
+        fields = line.split('\t')
+        if fields[0] == "":
+            delta_distances_km = [float(distance_km) for distance_km in fields[1].split()]
+            progress_size += len(line)
+            continue
+        completed_tokens.add(unicode(fields[0], 'utf-8'))
+        kscore_analysis_size = int(fields[1])
+        progress_size += len(line)
+    logging.debug("There are " + str(len(completed_tokens)) + " completed primary tokens")
+    return completed_tokens, kscore_analysis_size, progress_size, delta_distances_km
+
 def read_bigrams(filename):
     logging.debug("Reading bigrams")
     infile = open(filename, "r")
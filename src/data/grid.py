@@ -0,0 +1,119 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition: The grid cells must not overlap.
+@summary: Definition of the grid that divides the region of interest into grid cells.
+The bounds, centers and ids of cells are kept in arrays, and a cell is found by its gcid without assuming that gcids are the positions of cells.
+The grid cells of points are found together: by arithmetic in regular grids, and otherwise by a lattice of the sorted edges of cells,
+where each lattice cell refers to the grid cell that covers it.
+A Grid can be used as the list of its GridCell instances.
+'''
+
+import numpy as np
+
+# The lattice of an irregular grid is used if it has at most this many lattice cells per grid cell. Otherwise, the cells are checked for each point.
+MAX_LATTICE_CELLS_PER_GRIDCELL = 16
+# Upper bound for the number of point and grid cell pairs checked at once without a lattice
+MAX_CELL_CHECKS_IN_CHUNK = 2**22
+
+class Grid(object):
+    def __init__(self, gridcells):
+        self.gridcells = list(gridcells)
+        if len(self.gridcells) == 0:
+            raise ValueError("The grid has no cells")
+        self.gcids = np.array([gridcell.gcid for gridcell in self.gridcells], dtype=int)
+        self.latmins = np.array([gridcell.latmin for gridcell in self.gridcells], dtype=np.float64)
+        self.lonmins = np.array([gridcell.lonmin for gridcell in self.gridcells], dtype=np.float64)
+        self.latmaxs = np.array([gridcell.latmax for gridcell in self.gridcells], dtype=np.float64)
+        self.lonmaxs = np.array([gridcell.lonmax for gridcell in self.gridcells], dtype=np.float64)
+        if len(np.unique(self.gcids)) != len(self.gcids):
+            raise ValueError("The ids of grid cells are not unique")
+        if not (np.all(self.latmins < self.latmaxs) and np.all(self.lonmins < self.lonmaxs)):
+            raise ValueError("The minimum coordinates of a grid cell must be less than its maximum coordinates")
+        self.latmin, self.lonmin = np.min(self.latmins), np.min(self.lonmins)
+        self.latmax, self.lonmax = np.max(self.latmaxs), np.max(self.lonmaxs)
+        self.center_lats = (self.latmins + self.latmaxs) / 2.0
+        self.center_lons = (self.lonmins + self.lonmaxs) / 2.0
+        self.positions_of_gcids = dict((gcid, i) for i, gcid in enumerate(self.gcids.tolist()))
+        # the positions of cells in the order of their gcids, so that the positions of many gcids are found by a binary search
+        self.positions_in_gcid_order = np.argsort(self.gcids, kind='mergesort')
+        self.sorted_gcids = self.gcids[self.positions_in_gcid_order]
+        self.lat_edges = np.unique(np.concatenate((self.latmins, self.latmaxs)))
+        self.lon_edges = np.unique(np.concatenate((self.lonmins, self.lonmaxs)))
+        self.is_regular = is_regular_lattice(self.lat_edges, self.lon_edges, len(self.gridcells))
+        self.lattice_positions = None
+        n_lattice_cells = (len(self.lat_edges) - 1) * (len(self.lon_edges) - 1)
+        if self.is_regular or n_lattice_cells <= MAX_LATTICE_CELLS_PER_GRIDCELL * len(self.gridcells):
+            self.lattice_positions = self.get_lattice_positions()
+
+    def __len__(self):
+        return len(self.gridcells)
+
+    def __iter__(self):
+        return iter(self.gridcells)
+
+    def __getitem__(self, index):
+        return self.gridcells[index]
+
+    def get_gridcell(self, gcid):
+        return self.gridcells[self.positions_of_gcids[gcid]]
+
+    def get_positions(self, gcids):
+        gcids = np.asarray(gcids, dtype=int)
+        indices = np.minimum(np.searchsorted(self.sorted_gcids, gcids), len(self.sorted_gcids) - 1)
+        if not np.all(self.sorted_gcids[indices] == gcids):
+            raise ValueError("The grid has no cells with ids " + str(np.unique(gcids[self.sorted_gcids[indices] != gcids]).tolist()))
+        return self.positions_in_gcid_order[indices]
+
+    def get_lattice_positions(self):
+        # lattice_positions[i, j] is the position of the grid cell that covers the lattice cell between lat_edges[i:i+2] and lon_edges[j:j+2], or -1
+        lattice_positions = -np.ones((len(self.lat_edges) - 1, len(self.lon_edges) - 1), dtype=int)
+        rows_start, rows_end = np.searchsorted(self.lat_edges, self.latmins), np.searchsorted(self.lat_edges, self.latmaxs)
+        cols_start, cols_end = np.searchsorted(self.lon_edges, self.lonmins), np.searchsorted(self.lon_edges, self.lonmaxs)
+        if self.is_regular:
+            lattice_positions[rows_start, cols_start] = np.arange(len(self.gridcells))
+            return lattice_positions
+        for position in range(len(self.gridcells)):
+            lattice_positions[rows_start[position]:rows_end[position], cols_start[position]:cols_end[position]] = position
+        return lattice_positions
+
+    def get_gcids_of_points(self, lats, lons):
+        # A point on the edge between two cells is in the cell at its north or east, except on the northern and eastern edges of the grid.
+        # The points outside the grid get -1.
+        positions = self.get_positions_of_points(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+        return np.where(positions >= 0, self.gcids[positions], -1)
+
+    def get_positions_of_points(self, lats, lons):
+        is_inside = (lats >= self.latmin) & (lats <= self.latmax) & (lons >= self.lonmin) & (lons <= self.lonmax)
+        if self.lattice_positions is None:
+            return self.get_positions_of_points_by_checking_cells(lats, lons, is_inside)
+        rows = get_lattice_indices(lats, self.lat_edges, self.is_regular)
+        cols = get_lattice_indices(lons, self.lon_edges, self.is_regular)
+        return np.where(is_inside, self.lattice_positions[rows, cols], -1)
+
+    def get_positions_of_points_by_checking_cells(self, lats, lons, is_inside):
+        positions = -np.ones(len(lats), dtype=int)
+        chunk_size = max(1, MAX_CELL_CHECKS_IN_CHUNK // len(self.gridcells))
+        for chunk_start in range(0, len(lats), chunk_size):
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            chunk_lats, chunk_lons = lats[chunk, np.newaxis], lons[chunk, np.newaxis]
+            is_in_cell = (chunk_lats >= self.latmins) & (chunk_lons >= self.lonmins) & \
+                ((chunk_lats < self.latmaxs) | (self.latmaxs == self.latmax)) & ((chunk_lons < self.lonmaxs) | (self.lonmaxs == self.lonmax))
+            positions[chunk] = np.where(is_in_cell.any(axis=1), np.argmax(is_in_cell, axis=1), -1)
+        return np.where(is_inside, positions, -1)
+
+def get_lattice_indices(values, edges, is_regular):
+    # index i of a value means edges[i] <= value < edges[i+1], and the values on the last edge are in the last interval
+    n_intervals = len(edges) - 1
+    if not is_regular:
+        return np.clip(np.searchsorted(edges, values, side='right') - 1, 0, n_intervals - 1)
+    indices = np.clip(np.floor((values - edges[0]) / ((edges[-1] - edges[0]) / n_intervals)).astype(int), 0, n_intervals - 1)
+    # the arithmetic may put a value next to an edge into the neighboring interval
+    indices = indices - (values < edges[indices]) + (values >= edges[indices + 1])
+    return np.clip(indices, 0, n_intervals - 1)
+
+def is_regular_lattice(lat_edges, lon_edges, number_of_cells):
+    if len(lat_edges) < 2 or len(lon_edges) < 2 or (len(lat_edges) - 1) * (len(lon_edges) - 1) != number_of_cells:
+        return False
+    lat_steps, lon_steps = np.diff(lat_edges), np.diff(lon_edges)
+    return np.allclose(lat_steps, lat_steps[0]) and np.allclose(lon_steps, lon_steps[0])
@@ -0,0 +1,57 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: Definition of the inverted index that maps tokens to the tweets containing them.
+The index is a sparse tweet x token matrix in compressed sparse column format, so the tweets of a token are found without scanning other tokens.
+New tweets can be added to the index, and their new tokens are added to the tokens dictionary.
+'''
+
+import numpy as np
+from scipy import sparse
+
+class TokenIndex:
+    def __init__(self, tokens_dictionary, tgms):
+        self.tokens_dictionary = tokens_dictionary
+        self.tgm_token_matrix = get_sparse_feature_matrix(tokens_dictionary, tgms)
+
+    def add(self, tgms):
+        for tgm in tgms:
+            for token in tgm.tokens:
+                self.tokens_dictionary.setdefault(token, len(self.tokens_dictionary))
+        tgm_token_matrix_to_add = get_sparse_feature_matrix(self.tokens_dictionary, tgms)
+        tgm_token_matrix = get_resized_matrix(self.tgm_token_matrix, (self.tgm_token_matrix.shape[0], len(self.tokens_dictionary)))
+        self.tgm_token_matrix = sparse.vstack([tgm_token_matrix, tgm_token_matrix_to_add], format='csc')
+        self.tgm_token_matrix.sort_indices()
+
+    def get_tgm_indices_with_token_id(self, token_id):
+        indptr = self.tgm_token_matrix.indptr
+        return self.tgm_token_matrix.indices[indptr[token_id]:indptr[token_id + 1]]
+
+    def get_tgm_indices_with_token(self, token):
+        token_id = self.tokens_dictionary.get(token)
+        if token_id is None:
+            return np.array([], dtype=self.tgm_token_matrix.indices.dtype)
+        return self.get_tgm_indices_with_token_id(token_id)
+
+def get_sparse_feature_matrix(tokens_dictionary, tgms):
+    rowArr = []
+    colArr = []
+    tweetCounter = 0
+    for tgm in tgms:
+        for tokenInTweet in set(tgm.tokens):
+            tokenIndex = tokens_dictionary.get(tokenInTweet)
+            if tokenIndex is not None:
+                rowArr.append(tweetCounter)
+                colArr.append(tokenIndex)
+        tweetCounter += 1
+    dataArr = np.ones(len(rowArr), dtype=np.int32)
+    tgm_token_matrix = sparse.csc_matrix((dataArr, (rowArr, colArr)), shape=(len(tgms), len(tokens_dictionary)))
+    tgm_token_matrix.sort_indices()
+    return tgm_token_matrix
+
+def get_resized_matrix(matrix, shape):
+    # Adds empty rows and columns to the end of a CSR or CSC matrix
+    n_major = shape[0] if sparse.isspmatrix_csr(matrix) else shape[1]
+    indptr = np.concatenate([matrix.indptr, np.repeat(matrix.indptr[-1], n_major + 1 - len(matrix.indptr))])
+    return matrix.__class__((matrix.data, matrix.indices, indptr), shape=shape)
@@ -0,0 +1,59 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary:
+'''
+
+'''
+The probabilities of grid cells for tokens with at least this many observations are approximated by binning their observations 
+onto a raster and convolving with the kernel via FFT (see prediction.binned_kde), instead of integrating the kernel exactly. 
+None disables the approximation. It is applied only if the grid is regular.
+'''
+BINNED_KDE_MIN_OBSERVATIONS = None
+'''
+Each grid cell is divided into BINNED_KDE_SUBDIVISIONS x BINNED_KDE_SUBDIVISIONS subcells in the raster of the binned approximation.
+'''
+BINNED_KDE_SUBDIVISIONS = 8
+'''
+For this many binned tokens, the exact probabilities are also calculated to report the error of the approximation.
+'''
+BINNED_KDE_ERROR_CHECKS = 10
+'''
+The trained model is a matrix of the probabilities of tokens in grid cells. Probabilities below MODEL_PROBABILITY_EPSILON are dropped, 
+and the matrix is stored as a sparse CSR matrix. None keeps all probabilities in a dense matrix.
+'''
+MODEL_PROBABILITY_EPSILON = None
+'''
+Number of tweets whose grid cell scores are calculated together by KDESum.predict_batch. 
+The scores of a batch take PREDICTION_BATCH_SIZE x (number of grid cells) x 8 bytes.
+'''
+PREDICTION_BATCH_SIZE = 10000
+'''
+Number of tokens sent together to a worker process when KDESum is trained with multiple workers.
+'''
+TRAINING_CHUNK_SIZE = 16
+'''
+Size bound of the disk cache at data.kde_cache_directory. The least recently used files are removed when the cache grows beyond it.
+'''
+KDE_CACHE_MAX_BYTES = 2**30
+'''
+Distance between the location of a test tweet and the center of its predicted grid cell in the evaluation (see prediction.evaluation).
+'vincenty' measures it on the WGS-84 ellipsoid, and 'great_circle' on a sphere, which is slightly less accurate and faster.
+'''
+EVALUATION_DISTANCE = 'vincenty'
+'''
+The evaluation reports the ratio of test tweets whose error distances are within each of these distances.
+'''
+EVALUATION_ACCURACY_DISTANCES_KM = [1, 10, 100, 161]
+'''
+If True and the grid is regular, the model is organized by a quadtree of coarse cells over the grid (see prediction.quadtree).
+Predictions score the coarse cells first and refine only the branches that can contain the best grid cell, which is the same as in flat scoring.
+If MODEL_PROBABILITY_EPSILON is set, the kernels of tokens are also integrated from the coarse cells, and only the cells with 
+probabilities of at least MODEL_PROBABILITY_EPSILON are refined to their grid cells.
+'''
+HIERARCHICAL_GRID = False
+'''
+The coarsest level of the quadtree has at most this many cells.
+'''
+QUADTREE_ROOT_CELLS = 64
@@ -0,0 +1,66 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition: The grid must be regular, i.e. its cells must have the same size and cover a rectangular region without gaps.
+@summary: This file includes the functions to approximate the probabilities of grid cells for a gaussian_kde by binning.
+The observations of a token are distributed by linear binning onto a raster that divides each grid cell into subcells. 
+The binned counts are convolved via FFT with the probabilities of the kernel over the subcells, and the subcells are summed into grid cells.
+The cost depends on the size of the raster instead of the number of observations times the number of grid cells.
+'''
+
+import numpy as np
+from scipy import signal
+from prediction import kde_integration
+
+# The kernel is truncated at this many standard deviations, unless it already covers the whole raster
+KERNEL_TRUNCATION_STDS = 5.0
+
+class GridRaster:
+    def __init__(self, grid, subdivisions):
+        self.subdivisions = subdivisions
+        self.n_rows, self.n_cols = len(grid.lat_edges) - 1, len(grid.lon_edges) - 1
+        self.is_regular = grid.is_regular
+        if not self.is_regular:
+            return
+        self.latmin, self.lonmin = grid.lat_edges[0], grid.lon_edges[0]
+        self.lat_step = (grid.lat_edges[-1] - grid.lat_edges[0]) / (self.n_rows * subdivisions)
+        self.lon_step = (grid.lon_edges[-1] - grid.lon_edges[0]) / (self.n_cols * subdivisions)
+        self.gridcell_rows = np.searchsorted(grid.lat_edges, grid.latmins)
+        self.gridcell_cols = np.searchsorted(grid.lon_edges, grid.lonmins)
+
+    def get_binned_counts(self, lats, lons):
+        n_lat, n_lon = self.n_rows * self.subdivisions, self.n_cols * self.subdivisions
+        # positions relative to the centers of subcells, so each observation is shared by the four nearest centers
+        lat_positions = (lats - self.latmin) / self.lat_step - 0.5
+        lon_positions = (lons - self.lonmin) / self.lon_step - 0.5
+        lat_indices, lon_indices = np.floor(lat_positions).astype(int), np.floor(lon_positions).astype(int)
+        lat_fractions, lon_fractions = lat_positions - lat_indices, lon_positions - lon_indices
+        counts = np.zeros(n_lat * n_lon)
+        for lat_offset, lat_weights in ((0, 1.0 - lat_fractions), (1, lat_fractions)):
+            for lon_offset, lon_weights in ((0, 1.0 - lon_fractions), (1, lon_fractions)):
+                # observations on the borders of the raster are assigned to the subcells on the border
+                rows = np.clip(lat_indices + lat_offset, 0, n_lat - 1)
+                cols = np.clip(lon_indices + lon_offset, 0, n_lon - 1)
+                counts += np.bincount(rows * n_lon + cols, weights=lat_weights * lon_weights, minlength=n_lat * n_lon)
+        return counts.reshape((n_lat, n_lon))
+
+    def get_kernel_weights(self, covariance):
+        n_lat, n_lon = self.n_rows * self.subdivisions, self.n_cols * self.subdivisions
+        std_lat, std_lon = np.sqrt(covariance[0, 0]), np.sqrt(covariance[1, 1])
+        r = covariance[0, 1] / (std_lat * std_lon)
+        lat_radius = min(n_lat - 1, int(np.ceil(KERNEL_TRUNCATION_STDS * std_lat / self.lat_step)))
+        lon_radius = min(n_lon - 1, int(np.ceil(KERNEL_TRUNCATION_STDS * std_lon / self.lon_step)))
+        # edges of the subcells around the subcell of an observation, in standard deviations
+        lat_edges = (np.arange(-lat_radius, lat_radius + 2) - 0.5) * self.lat_step / std_lat
+        lon_edges = (np.arange(-lon_radius, lon_radius + 2) - 0.5) * self.lon_step / std_lon
+        h, k = np.meshgrid(lat_edges, lon_edges, indexing='ij')
+        cdf = kde_integration.get_bivariate_normal_cdf(h, k, r)
+        return np.diff(np.diff(cdf, axis=0), axis=1)
+
+def integrate_kernel_over_grid(kernel, grid_raster):
+    counts = grid_raster.get_binned_counts(kernel.dataset[0], kernel.dataset[1])
+    kernel_weights = grid_raster.get_kernel_weights(kernel.covariance)
+    subcell_probabilities = np.maximum(signal.fftconvolve(counts, kernel_weights, mode='same'), 0.0) / kernel.n
+    s = grid_raster.subdivisions
+    cell_probabilities = subcell_probabilities.reshape((grid_raster.n_rows, s, grid_raster.n_cols, s)).sum(axis=3).sum(axis=1)
+    return cell_probabilities[grid_raster.gridcell_rows, grid_raster.gridcell_cols]
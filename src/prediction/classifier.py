@@ -5,6 +5,10 @@
 @summary: This file includes the class definition that performs prediction using KDE. 
 Training is performed during the initialization of an instance.
 predictLocation() can be called after the training (initialization) is finished. 
+update() trains the model with new tweets, refitting only the kernels of the tokens in these tweets. The predictions use the previous model until the update is finished.
+An update in the background cannot use worker processes.
+A trained model can be saved to a directory, and loaded with KDESum.load() without training.
+If prediction.HIERARCHICAL_GRID is set, the model is organized by a quadtree over the grid (see prediction.quadtree).
 '''
 
 import logging
@@ -12,116 +16,296 @@ import logging
 from _collections import defaultdict
 import numpy as np
 import warnings
-from prediction import information_gain_ratio, cooc_feature_space
+from prediction import information_gain_ratio, cooc_feature_space, kde_integration, binned_kde, kde_cache, kde_model, quadtree
+import prediction
 import operator
-from data import datareader
+from data import datareader, token_index
 import data
 from scipy import stats
 from numpy.core.shape_base import atleast_2d
 from numpy import linalg
+import time
+import multiprocessing
+import threading
 
 SCOTT_CONSTANT = -0.166666666666667
 
-class KDESum:
-    def __init__(self, grid, tgms_training, tokens_set):
+'''
+The KDESum instance under training, shared with the worker processes of a parallel training. It is set before the worker processes are forked,
+so the workers use its grid and configuration without pickling them for every token.
+'''
+shared_kde_sum = None
+
+class KDESum(object):
+    def __init__(self, grid, tgms_training, tokens_set, workers=1, tgms_training_original=None):
+        # tgms_training_original are the training tweets with their tokens before extending the feature space with bigrams. 
+        # They are read from data.training_file if not given.
         logging.debug("init KDE_SUM")
         warnings.simplefilter("error", RuntimeWarning)
         self.grid = grid
         self.tokens_set = tokens_set
-        self.inf_gain_ratios = self.get_inf_gain_ratios()
-        token_with_min_igr = min(self.inf_gain_ratios, key = lambda x: self.inf_gain_ratios.get(x) )
-        self.min_inf_gain_ratio_score = self.inf_gain_ratios[token_with_min_igr]
-        self.token_tgms_mappings = defaultdict(list)
-        for tgm in tgms_training:
-            tgm_tokens_set = set(tgm.tokens)
-            for token in tgm_tokens_set:
-                self.token_tgms_mappings[token].append(tgm)
+        self.stage_seconds = []
+        self.update_lock = threading.Lock()
+        stage_start_time = time.time()
+        if tgms_training_original is None:
+            tgms_training_original = datareader.readTweetGridMaps(data.training_file, grid if data.assign_gridcells else None)
+        self.bigrams_set = datareader.read_bigrams(data.kscore_analysis_file)
+        self.unigram_counts = information_gain_ratio.TokenGridCellCounts()
+        self.bigram_counts = information_gain_ratio.TokenGridCellCounts()
+        self.add_inf_gain_counts(tgms_training_original)
+        self.set_inf_gain_ratios()
+        stage_start_time = self.end_stage("information gain ratios", stage_start_time)
         self.grid_tgm_counts = defaultdict(int)
         for tgm in tgms_training:
             self.grid_tgm_counts[tgm.gcid] += 1
-        self.gcid_with_max_prior = max(self.grid_tgm_counts.iteritems(), key=operator.itemgetter(1))[0]
         tokens_list = list(self.tokens_set)
         list.sort(tokens_list)
-        self.gc_probabilities_dict_for_tokens = {}
-        logging.debug("Finding prior probabilities for tokens...")
-        for token in tokens_list:
-            observation_coordinates = self.get_observation_coordinates_of_token(token)
-            if len(observation_coordinates[0]) < 2:
+        self.tokens_index = token_index.TokenIndex(dict((token, i) for i, token in enumerate(tokens_list)), tgms_training)
+        self.tgm_lats = np.array([tgm.lat for tgm in tgms_training])
+        self.tgm_lons = np.array([tgm.lon for tgm in tgms_training])
+        self.grid_corners = kde_integration.GridCorners(grid)
+        self.grid_raster = binned_kde.GridRaster(grid, prediction.BINNED_KDE_SUBDIVISIONS)
+        if prediction.BINNED_KDE_MIN_OBSERVATIONS is not None and not self.grid_raster.is_regular:
+            logging.warning("The grid is not regular, so the probabilities of all tokens are integrated exactly.")
+        self.quadtree = quadtree.get_quadtree(grid) if prediction.HIERARCHICAL_GRID else None
+        if prediction.HIERARCHICAL_GRID and self.quadtree is None:
+            logging.warning("The grid is not regular, so the model is not organized by a quadtree.")
+        self.gcids = grid.gcids
+        self.set_priors()
+        self.kde_cache = None
+        if data.kde_cache_directory is not None:
+            self.kde_cache = kde_cache.KDECache(data.kde_cache_directory, prediction.KDE_CACHE_MAX_BYTES)
+            self.grid_fingerprint = kde_cache.get_grid_fingerprint(grid)
+        stage_start_time = self.end_stage("token index and grid", stage_start_time)
+        self.kde_statistics = defaultdict(float)
+        model_tokens = []
+        gc_probabilities_of_tokens = []
+        logging.debug("Finding prior probabilities for tokens using " + str(workers) + " workers...")
+        for token, gc_probabilities, kde_statistics_of_token in self.fit_tokens(tokens_list, workers):
+            merge_kde_statistics(self.kde_statistics, kde_statistics_of_token)
+            if gc_probabilities is None:
                 continue
-            bw = pow(len(observation_coordinates[0]), SCOTT_CONSTANT) * (( 1.0 - self.inf_gain_ratios[token]) + self.min_inf_gain_ratio_score)
-            kernel = stats.kde.gaussian_kde(observation_coordinates, bw)
-            self.gc_probabilities_dict_for_tokens[token] = self.get_probability_assignments(kernel, grid)
+            model_tokens.append(token)
+            gc_probabilities_of_tokens.append(self.get_model_row(gc_probabilities))
+        stage_start_time = self.end_stage("kernels", stage_start_time)
+        self.set_model(model_tokens, gc_probabilities_of_tokens)
+        self.end_stage("model matrix", stage_start_time)
         logging.debug("Initialization finished")
+
+    def update(self, new_tgms, workers=1, background=False):
+        # new_tgms are the new training tweets with their tokens before extending the feature space with bigrams.
+        # The kernels of the tokens in new_tgms are fitted again, and the other tokens keep their probabilities with updated weights.
+        # A background update runs in a thread, which is returned. Updates are applied one at a time.
+        # A background update fits the kernels in its thread, since forking worker processes from a thread other than the main thread can deadlock.
+        if not hasattr(self, 'tokens_index'):
+            raise ValueError("A loaded model cannot be updated without its training data")
+        if background and workers > 1:
+            raise ValueError("A background update cannot use worker processes")
+        if background:
+            update_thread = threading.Thread(target=self.update, args=(new_tgms, workers))
+            update_thread.start()
+            return update_thread
+        with self.update_lock:
+            start_time = time.time()
+            self.add_inf_gain_counts(new_tgms)
+            self.set_inf_gain_ratios()
+            tgms_training = cooc_feature_space.copy_tgms(new_tgms)
+            merged_token_pairs = cooc_feature_space.read_merged_token_pairs()
+            if merged_token_pairs is not None:
+                cooc_feature_space.replace_bigrams_in_tgms(tgms_training, merged_token_pairs)
+            tgms_training = [tgm for tgm in tgms_training if len(tgm.tokens) > 0]
+            updated_tokens = set()
+            for tgm in tgms_training:
+                updated_tokens.update(tgm.tokens)
+                self.grid_tgm_counts[tgm.gcid] += 1
+            self.tokens_set.update(updated_tokens)
+            self.tokens_index.add(tgms_training)
+            self.tgm_lats = np.concatenate([self.tgm_lats, [tgm.lat for tgm in tgms_training]])
+            self.tgm_lons = np.concatenate([self.tgm_lons, [tgm.lon for tgm in tgms_training]])
+            self.set_priors()
+            model = self.model
+            model_rows = {}
+            for token, gc_probabilities, kde_statistics_of_token in self.fit_tokens(sorted(updated_tokens), workers):
+                merge_kde_statistics(self.kde_statistics, kde_statistics_of_token)
+                if gc_probabilities is not None:
+                    model_rows[token] = self.get_model_row(gc_probabilities)
+            for token in model.model_tokens:
+                if token not in updated_tokens:
+                    model_rows[token] = model.get_model_row(model.token_rows[token])
+            model_tokens = sorted(model_rows)
+            self.set_model(model_tokens, [model_rows[token] for token in model_tokens])
+            logging.info("Updated the model with " + str(len(tgms_training)) + " tweets, fitting " + str(len(updated_tokens)) + " tokens in " + str(time.time() - start_time) + " seconds")
+
+    def end_stage(self, stage, stage_start_time):
+        stage_end_time = time.time()
+        self.stage_seconds.append((stage, stage_end_time - stage_start_time))
+        return stage_end_time
+
+    def fit_tokens(self, tokens_list, workers):
+        global shared_kde_sum
+        observations_of_tokens = list(self.get_observations_of_tokens(tokens_list))
+        cache_keys = [None] * len(observations_of_tokens)
+        if self.kde_cache is not None:
+            cache_keys = [self.get_cache_key(*observations_of_token) for observations_of_token in observations_of_tokens]
+        # the tokens found in the cache are decided before fitting, as the fitted tokens are added to the cache
+        is_cached = [cache_key is not None and self.kde_cache.contains(cache_key) for cache_key in cache_keys]
+        for cache_key, cached in zip(cache_keys, is_cached):
+            if cached:
+                self.kde_cache.reserve(cache_key)
+        observations_to_fit = [observations_of_token for observations_of_token, cached in zip(observations_of_tokens, is_cached) if not cached]
+        pool = None
+        if workers <= 1:
+            fitted_tokens = (self.fit_token(*observations_of_token) for observations_of_token in observations_to_fit)
+        else:
+            shared_kde_sum = self
+            pool = multiprocessing.Pool(workers)
+            # imap returns the fitted tokens in the order of tokens_list, so the model is the same as in a serial run
+            fitted_tokens = pool.imap(fit_shared_token, observations_to_fit, chunksize=prediction.TRAINING_CHUNK_SIZE)
+        for observations_of_token, cache_key, cached in zip(observations_of_tokens, cache_keys, is_cached):
+            if not cached:
+                fitted_token = next(fitted_tokens)
+            else:
+                gc_probabilities = self.kde_cache.get(cache_key)
+                if gc_probabilities is not None:
+                    yield observations_of_token[0], gc_probabilities, {'cached_tokens': 1}
+                    continue
+                # the file was removed after the tokens in the cache were decided
+                fitted_token = self.fit_token(*observations_of_token)
+            if cache_key is not None and fitted_token[1] is not None:
+                self.kde_cache.put(cache_key, fitted_token[1])
+            yield fitted_token
+        if pool is not None:
+            pool.close()
+            pool.join()
+            shared_kde_sum = None
+
+    def get_cache_key(self, token, observation_lats, observation_lons, check_binned):
+        # the bandwidth and the integration settings determine the probabilities, together with the observations and the grid
+        if len(observation_lats) < 2:
+            return None
+        bw = pow(len(observation_lats), SCOTT_CONSTANT) * (( 1.0 - self.inf_gain_ratios[token]) + self.min_inf_gain_ratio_score)
+        if prediction.BINNED_KDE_MIN_OBSERVATIONS is None or not self.grid_raster.is_regular:
+            integration_settings = "exact"
+        else:
+            integration_settings = "binned %d %d %r" % (prediction.BINNED_KDE_MIN_OBSERVATIONS, prediction.BINNED_KDE_SUBDIVISIONS, binned_kde.KERNEL_TRUNCATION_STDS)
+        if self.is_quadtree_integration_applicable():
+            integration_settings += " quadtree %r %d" % (prediction.MODEL_PROBABILITY_EPSILON, prediction.QUADTREE_ROOT_CELLS)
+        return kde_cache.get_cache_key(observation_lats, observation_lons, bw, self.grid_fingerprint, integration_settings)
+
+    def get_observations_of_tokens(self, tokens_list):
+        n_binned_checks = 0
+        for token in tokens_list:
+            tgm_indices_of_token = self.tokens_index.get_tgm_indices_with_token(token)
+            check_binned = self.is_binned_kde_applicable(len(tgm_indices_of_token)) and n_binned_checks < prediction.BINNED_KDE_ERROR_CHECKS
+            n_binned_checks += check_binned
+            yield token, self.tgm_lats[tgm_indices_of_token], self.tgm_lons[tgm_indices_of_token], check_binned
+
+    def fit_token(self, token, observation_lats, observation_lons, check_binned):
+        kde_statistics_of_token = defaultdict(float)
+        observation_coordinates = self.get_observation_coordinates_of_token(token, observation_lats, observation_lons)
+        if len(observation_coordinates[0]) < 2:
+            return token, None, kde_statistics_of_token
+        bw = pow(len(observation_coordinates[0]), SCOTT_CONSTANT) * (( 1.0 - self.inf_gain_ratios[token]) + self.min_inf_gain_ratio_score)
+        kernel = stats.kde.gaussian_kde(observation_coordinates, bw)
+        gc_probabilities = self.get_probability_assignments(kernel, kde_statistics_of_token, check_binned)
+        return token, gc_probabilities, kde_statistics_of_token
         
-    def get_inf_gain_ratios(self):
-        unigram_inf_gain_ratios = self.get_unigram_inf_gain_ratios()
-        bigram_inf_gain_ratios = self.get_bigram_inf_gain_ratios()
-        inf_gain_ratios = dict(unigram_inf_gain_ratios.items() + bigram_inf_gain_ratios.items())
-        return inf_gain_ratios
-
-    def get_unigram_inf_gain_ratios(self):
-        tgms_training = datareader.readTweetGridMaps(data.training_file)
-        tokens_set = set()
-        for tgm in tgms_training:
-            tokens_set = tokens_set.union(set(tgm.tokens))
-        tokens_list = list(tokens_set)
-        unigram_inf_gain_ratios = information_gain_ratio.find_inf_gain_ratios(tgms_training, tokens_list)        
-        return unigram_inf_gain_ratios
-    
-    def get_bigram_inf_gain_ratios(self):
-        tgms_training = datareader.readTweetGridMaps(data.training_file)
-        bigrams_set = datareader.read_bigrams(data.kscore_analysis_file)
-        cooc_feature_space.generate_bigrams_from_unigrams(tgms_training, bigrams_set)
-        tgms_training = [tgm for tgm in tgms_training if len(tgm.tokens) > 0]
-        tokens_set = set()
-        for tgm in tgms_training:
-            tokens_set = tokens_set.union(set(tgm.tokens))
-        tokens_list = list(tokens_set)
-        bigram_inf_gain_ratios = information_gain_ratio.find_inf_gain_ratios(tgms_training, tokens_list)        
-        return bigram_inf_gain_ratios    
+    def add_inf_gain_counts(self, tgms_original):
+        self.unigram_counts.add(tgms_original)
+        tgms_bigrams = cooc_feature_space.copy_tgms(tgms_original)
+        cooc_feature_space.generate_bigrams_from_unigrams(tgms_bigrams, self.bigrams_set)
+        self.bigram_counts.add([tgm for tgm in tgms_bigrams if len(tgm.tokens) > 0])
+
+    def set_inf_gain_ratios(self):
+        self.inf_gain_ratios = dict(self.unigram_counts.get_inf_gain_ratios().items() + self.bigram_counts.get_inf_gain_ratios().items())
+        token_with_min_igr = min(self.inf_gain_ratios, key = lambda x: self.inf_gain_ratios.get(x) )
+        self.min_inf_gain_ratio_score = self.inf_gain_ratios[token_with_min_igr]
+
+    def set_priors(self):
+        self.gcid_with_max_prior = max(self.grid_tgm_counts.iteritems(), key=operator.itemgetter(1))[0]
+        self.gc_priors = np.array([self.grid_tgm_counts[gcid] for gcid in self.gcids], dtype=float) / sum(self.grid_tgm_counts.itervalues())
     
-    def get_observation_coordinates_of_token(self, token):
-        tgms_of_token = self.token_tgms_mappings[token]
-        observation_coordinates = [[],[]]
-        if len(tgms_of_token) < 2:
-            return observation_coordinates
-        for tgm in tgms_of_token:
-            observation_coordinates[0].append(tgm.lat)
-            observation_coordinates[1].append(tgm.lon)
+    def get_observation_coordinates_of_token(self, token, observation_lats, observation_lons):
+        if len(observation_lats) < 2:
+            return [[],[]]
+        observation_coordinates = [observation_lats.tolist(), observation_lons.tolist()]
         _cov = atleast_2d(np.cov(observation_coordinates, rowvar=1, bias=False))
         _det = linalg.det(_cov)
         if _det <= 0:
             observation_coordinates = self.tune_observation_coordinates(observation_coordinates)
-        try:
-            bw = pow(len(observation_coordinates[0]), SCOTT_CONSTANT) * (( 1.0 - self.inf_gain_ratios[token]) + self.min_inf_gain_ratio_score)
-            stats.kde.gaussian_kde(observation_coordinates, bw)
-        except RuntimeWarning:
+        bw = pow(len(observation_coordinates[0]), SCOTT_CONSTANT) * (( 1.0 - self.inf_gain_ratios[token]) + self.min_inf_gain_ratio_score)
+        if not is_valid_kernel_covariance(observation_coordinates, bw):
             observation_coordinates = self.tune_observation_coordinates(observation_coordinates)
         return observation_coordinates
     
-    def get_probability_assignments(self, kernel, grid):
-        gc_probabilities_dict = defaultdict(float)
-        for gridcell in grid:
-            gc_probability = kernel.integrate_box((gridcell.latmin, gridcell.lonmin), (gridcell.latmax, gridcell.lonmax))
-            gc_probabilities_dict[gridcell.gcid] = np.nan_to_num(gc_probability)
-        return gc_probabilities_dict
-    
-    def predictLocation(self, tokens_in_tweet):
-        gc_probabilities_for_tweet = defaultdict(float)
-        token_found = False
-        for token in tokens_in_tweet:
-            gc_probabilities_dict_for_token = self.gc_probabilities_dict_for_tokens.get(token)
-            if gc_probabilities_dict_for_token == None:
-                continue
-            else:
-                token_found = True
-                for gcid in gc_probabilities_dict_for_token.keys():
-                    gc_probability_for_token = gc_probabilities_dict_for_token[gcid]
-                    gc_probabilities_for_tweet[gcid] += gc_probability_for_token * self.inf_gain_ratios[token]
-        if token_found:
-            return max(gc_probabilities_for_tweet.iteritems(), key=operator.itemgetter(1))[0]
+    def get_probability_assignments(self, kernel, kde_statistics, check_binned=False):
+        start_time = time.time()
+        if self.is_binned_kde_applicable(kernel.n):
+            gc_probabilities = binned_kde.integrate_kernel_over_grid(kernel, self.grid_raster)
+            binned_seconds = time.time() - start_time
+            kde_statistics['binned_tokens'] += 1
+            kde_statistics['binned_seconds'] += binned_seconds
+            if check_binned:
+                self.check_binned_probabilities(kernel, gc_probabilities, binned_seconds, kde_statistics)
+        elif self.is_quadtree_integration_applicable():
+            gc_probabilities, n_cdf_evaluations = quadtree.integrate_kernel_over_quadtree(kernel, self.quadtree, prediction.MODEL_PROBABILITY_EPSILON)
+            kde_statistics['quadtree_tokens'] += 1
+            kde_statistics['quadtree_seconds'] += time.time() - start_time
+            kde_statistics['quadtree_cdf_evaluations'] += n_cdf_evaluations
         else:
-            return self.gcid_with_max_prior    
+            gc_probabilities = kde_integration.integrate_kernel_over_grid(kernel, self.grid_corners)
+            kde_statistics['exact_tokens'] += 1
+            kde_statistics['exact_seconds'] += time.time() - start_time
+        return np.nan_to_num(gc_probabilities)
+
+    def get_model_row(self, gc_probabilities):
+        if prediction.MODEL_PROBABILITY_EPSILON is None:
+            return gc_probabilities.astype(np.float32)
+        is_kept = gc_probabilities >= prediction.MODEL_PROBABILITY_EPSILON
+        columns = np.flatnonzero(is_kept)
+        return columns, gc_probabilities[columns].astype(np.float32), np.sum(gc_probabilities[~is_kept])
+
+    def set_model(self, model_tokens, model_rows):
+        # The model is replaced at once, so the predictions that have started with the previous model are not affected.
+        token_weights = np.array([self.inf_gain_ratios[token] for token in model_tokens])
+        self.model = kde_model.create_model(model_tokens, model_rows, token_weights, self.gcids, self.gc_priors, self.gcid_with_max_prior, self.quadtree)
+        logging.info("The model has " + str(len(model_tokens)) + " tokens and uses " + str(self.model.get_size_in_bytes()) + " bytes")
+
+    def save(self, directory):
+        self.model.save(directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        kde_sum = cls.__new__(cls)
+        kde_sum.model = kde_model.load_model(directory, mmap_mode)
+        kde_sum.kde_statistics = defaultdict(float)
+        return kde_sum
+
+    def is_binned_kde_applicable(self, n_observations):
+        return prediction.BINNED_KDE_MIN_OBSERVATIONS is not None and n_observations >= prediction.BINNED_KDE_MIN_OBSERVATIONS and self.grid_raster.is_regular
+
+    def is_quadtree_integration_applicable(self):
+        # the cells of the quadtree are refined down to the probabilities that are kept in the model
+        return self.quadtree is not None and prediction.MODEL_PROBABILITY_EPSILON is not None
+
+    def check_binned_probabilities(self, kernel, gc_probabilities_binned, binned_seconds, kde_statistics):
+        start_time = time.time()
+        gc_probabilities_exact = np.nan_to_num(kde_integration.integrate_kernel_over_grid(kernel, self.grid_corners))
+        kde_statistics['binned_checked_exact_seconds'] += time.time() - start_time
+        kde_statistics['binned_checked_seconds'] += binned_seconds
+        kde_statistics['binned_checked_tokens'] += 1
+        abs_errors = np.abs(gc_probabilities_binned - gc_probabilities_exact)
+        kde_statistics['binned_max_abs_error'] = max(kde_statistics['binned_max_abs_error'], np.max(abs_errors))
+        kde_statistics['binned_max_total_variation'] = max(kde_statistics['binned_max_total_variation'], 0.5 * np.sum(abs_errors))
+
+    def predictLocation(self, tokens_in_tweet):
+        return self.predict_batch([tokens_in_tweet])[0]
+
+    def predict_batch(self, tokens_of_tweets):
+        return self.model.predict_batch(tokens_of_tweets)
+
+    def predict_top_k(self, tokens_of_tweets, k):
+        return self.model.predict_top_k(tokens_of_tweets, k)
     
     def tune_observation_coordinates(self, lats_and_lons):
         latlon_counts = defaultdict(int)
@@ -140,3 +324,22 @@ class KDESum:
         lats_and_lons[0].extend([latlon[0] - 0.001, latlon[0] - 0.001, latlon[0] + 0.001, latlon[0] + 0.001])
         lats_and_lons[1].extend([latlon[1] - 0.001, latlon[1] + 0.001, latlon[1] - 0.001, latlon[1] + 0.001])
         return lats_and_lons
+
+def is_valid_kernel_covariance(observation_coordinates, bw):
+    # gaussian_kde inverts the covariance of its kernel and takes the square root of its determinant, which must be well-defined
+    with np.errstate(all='ignore'):
+        kernel_covariance = atleast_2d(np.cov(observation_coordinates, rowvar=1, bias=False)) * bw**2
+        if not np.all(np.isfinite(kernel_covariance)):
+            return False
+        kernel_det = linalg.det(2 * np.pi * kernel_covariance)
+        return np.isfinite(kernel_det) and kernel_det > 0 and linalg.cond(kernel_covariance) < 1.0 / np.finfo(float).eps
+
+def fit_shared_token(observations_of_token):
+    return shared_kde_sum.fit_token(*observations_of_token)
+
+def merge_kde_statistics(kde_statistics, kde_statistics_to_add):
+    for key, value in kde_statistics_to_add.items():
+        if key.startswith('binned_max_'):
+            kde_statistics[key] = max(kde_statistics[key], value)
+        else:
+            kde_statistics[key] += value
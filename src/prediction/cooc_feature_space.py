@@ -10,6 +10,7 @@ from _collections import defaultdict
 import cooc
 import data
 from data import datareader
+from data.datamodel import TweetGridMap
 
 def replace_bigrams_in_tgms(tgms, replace_token_pairs):
     new_tokens = set()
@@ -71,6 +72,9 @@ def generate_bigrams_from_unigrams(tgms, bigrams_set):
         for bigram in bigrams_to_add:
             tgm.tokens.append(bigram)
 
+def copy_tgms(tgms):
+    return [TweetGridMap(tgm.gcid, tgm.lat, tgm.lon, list(tgm.tokens)) for tgm in tgms]
+
 def merge_token_pairs(token_pairs1, token_pairs2):
     merged_token_pairs = defaultdict(set)
     keys = token_pairs1.keys()
@@ -84,13 +88,23 @@ def merge_token_pairs(token_pairs1, token_pairs2):
             merged_token_pairs[key] = set(token_pairs2[key])
     return merged_token_pairs
 
-def extend_feature_space_with_bigrams(tgms_training, tgms_test, tokens_set):
+def read_merged_token_pairs():
     attraction_token_pairs, repulsion_token_pairs = datareader.read_kscore_token_pairs(data.kscore_analysis_file) 
     if len(attraction_token_pairs) == 0 and len(repulsion_token_pairs) == 0:
         logging.warn('There are no attraction or repulsion token pairs')
-        return
+        return None
     logging.debug("Found " + str(sum(len(v) for v in attraction_token_pairs.itervalues())) + " attraction_token_pairs and " + str(sum(len(v) for v in repulsion_token_pairs.itervalues())) + " repulsion_token_pairs")
-    merged_token_pairs = merge_token_pairs(attraction_token_pairs, repulsion_token_pairs)
+    return merge_token_pairs(attraction_token_pairs, repulsion_token_pairs)
+
+def extend_test_tweets_with_bigrams(tgms_test):
+    merged_token_pairs = read_merged_token_pairs()
+    if merged_token_pairs is not None:
+        replace_bigrams_in_tgms(tgms_test, merged_token_pairs)
+
+def extend_feature_space_with_bigrams(tgms_training, tgms_test, tokens_set):
+    merged_token_pairs = read_merged_token_pairs()
+    if merged_token_pairs is None:
+        return
     new_bigrams_in_training_tgms = replace_bigrams_in_tgms(tgms_training, merged_token_pairs)
     replace_bigrams_in_tgms(tgms_test, merged_token_pairs)
 
@@ -0,0 +1,131 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: This file includes the functions to evaluate the predicted grid cells of test tweets.
+The error distances between the locations of tweets and the centers of their predicted grid cells are calculated together for all tweets,
+either on the WGS-84 ellipsoid by the Vincenty formula as geopy.distance.vincenty, or on a sphere as geopy.distance.great_circle.
+The report includes the mean and median errors, the accuracies within distances, and the errors in the grid cells of tweets.
+'''
+
+import json
+import logging
+import numpy as np
+import prediction
+
+# Radius of the sphere of geopy.distance.great_circle and the WGS-84 ellipsoid of geopy.distance.vincenty, in kilometers
+EARTH_RADIUS_KM = 6372.795
+ELLIPSOID_MAJOR_KM, ELLIPSOID_MINOR_KM, ELLIPSOID_FLATTENING = 6378.137, 6356.7523142, 1 / 298.257223563
+VINCENTY_ITERATIONS = 20
+VINCENTY_CONVERGENCE_THRESHOLD = 10e-12
+
+def get_evaluation_report(grid, tgms_test, predicted_gcids, distance=None):
+    gcids = np.array([tgm.gcid for tgm in tgms_test], dtype=int)
+    lats = np.array([tgm.lat for tgm in tgms_test], dtype=float)
+    lons = np.array([tgm.lon for tgm in tgms_test], dtype=float)
+    predicted_gcids = np.asarray(predicted_gcids, dtype=int)
+    predicted_lats, predicted_lons = get_gridcell_centers(grid, predicted_gcids)
+    error_distances = get_distances_in_meters(lats, lons, predicted_lats, predicted_lons, distance)
+    report = get_error_report(error_distances, gcids == predicted_gcids)
+    report['distance'] = distance if distance is not None else prediction.EVALUATION_DISTANCE
+    report['gridcells'] = get_gridcell_reports(gcids, error_distances, gcids == predicted_gcids)
+    return report
+
+def get_error_report(error_distances, is_correct_gridcell):
+    report = {'n_tweets': len(error_distances)}
+    if len(error_distances) == 0:
+        return report
+    report['mean_error_meters'] = float(np.mean(error_distances))
+    report['median_error_meters'] = float(np.median(error_distances))
+    report['gridcell_accuracy'] = float(np.mean(is_correct_gridcell))
+    report['accuracy_within_km'] = dict(("%g" % distance_km, float(np.mean(error_distances <= distance_km * 1000.0))) for distance_km in prediction.EVALUATION_ACCURACY_DISTANCES_KM)
+    return report
+
+def get_gridcell_reports(gcids, error_distances, is_correct_gridcell):
+    # the tweets are sorted by their grid cells and error distances, so the errors of each grid cell are contiguous and sorted
+    order = np.lexsort((error_distances, gcids))
+    gcids, error_distances, is_correct_gridcell = gcids[order], error_distances[order], is_correct_gridcell[order]
+    gridcell_starts = np.flatnonzero(np.r_[True, gcids[1:] != gcids[:-1]]) if len(gcids) > 0 else np.zeros(0, dtype=int)
+    gridcell_counts = np.diff(np.r_[gridcell_starts, len(gcids)])
+    error_sums = np.add.reduceat(error_distances, gridcell_starts) if len(gcids) > 0 else np.zeros(0)
+    correct_counts = np.add.reduceat(is_correct_gridcell.astype(int), gridcell_starts) if len(gcids) > 0 else np.zeros(0)
+    medians = 0.5 * (error_distances[gridcell_starts + (gridcell_counts - 1) // 2] + error_distances[gridcell_starts + gridcell_counts // 2])
+    gridcell_reports = {}
+    for gcid, count, error_sum, median, correct_count in zip(gcids[gridcell_starts].tolist(), gridcell_counts.tolist(), error_sums.tolist(), medians.tolist(), correct_counts.tolist()):
+        gridcell_reports[str(gcid)] = {'n_tweets': count, 'mean_error_meters': error_sum / count, 'median_error_meters': median, 'gridcell_accuracy': float(correct_count) / count}
+    return gridcell_reports
+
+def get_gridcell_centers(grid, gcids):
+    positions = grid.get_positions(gcids)
+    return grid.center_lats[positions], grid.center_lons[positions]
+
+def get_distances_in_meters(lats1, lons1, lats2, lons2, distance=None):
+    if distance is None:
+        distance = prediction.EVALUATION_DISTANCE
+    if distance == 'great_circle':
+        return get_great_circle_distances_in_km(lats1, lons1, lats2, lons2) * 1000.0
+    if distance == 'vincenty':
+        return get_vincenty_distances_in_km(lats1, lons1, lats2, lons2) * 1000.0
+    raise ValueError("Unknown distance: " + str(distance))
+
+def get_great_circle_distances_in_km(lats1, lons1, lats2, lons2):
+    lats1, lons1, lats2, lons2 = np.radians(lats1), np.radians(lons1), np.radians(lats2), np.radians(lons2)
+    sin_lats1, cos_lats1 = np.sin(lats1), np.cos(lats1)
+    sin_lats2, cos_lats2 = np.sin(lats2), np.cos(lats2)
+    delta_lons = lons2 - lons1
+    cos_delta_lons, sin_delta_lons = np.cos(delta_lons), np.sin(delta_lons)
+    d = np.arctan2(np.sqrt((cos_lats2 * sin_delta_lons) ** 2 + (cos_lats1 * sin_lats2 - sin_lats1 * cos_lats2 * cos_delta_lons) ** 2),
+                   sin_lats1 * sin_lats2 + cos_lats1 * cos_lats2 * cos_delta_lons)
+    return EARTH_RADIUS_KM * d
+
+def get_vincenty_distances_in_km(lats1, lons1, lats2, lons2):
+    # The iterations of a pair stop changing its values once it converges, as in geopy.distance.vincenty.
+    # The pairs that do not converge, which are nearly antipodal, are measured by the great-circle distance.
+    f = ELLIPSOID_FLATTENING
+    delta_lons = np.radians(lons2) - np.radians(lons1)
+    reduced_lats1 = np.arctan((1 - f) * np.tan(np.radians(lats1)))
+    reduced_lats2 = np.arctan((1 - f) * np.tan(np.radians(lats2)))
+    sin_reduced1, cos_reduced1 = np.sin(reduced_lats1), np.cos(reduced_lats1)
+    sin_reduced2, cos_reduced2 = np.sin(reduced_lats2), np.cos(reduced_lats2)
+    lambda_lons = delta_lons
+    is_converged = np.zeros(len(delta_lons), dtype=bool)
+    with np.errstate(all='ignore'):
+        for _ in range(VINCENTY_ITERATIONS):
+            sin_lambda_lons, cos_lambda_lons = np.sin(lambda_lons), np.cos(lambda_lons)
+            sin_sigma = np.sqrt((cos_reduced2 * sin_lambda_lons) ** 2 + (cos_reduced1 * sin_reduced2 - sin_reduced1 * cos_reduced2 * cos_lambda_lons) ** 2)
+            cos_sigma = sin_reduced1 * sin_reduced2 + cos_reduced1 * cos_reduced2 * cos_lambda_lons
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = cos_reduced1 * cos_reduced2 * sin_lambda_lons / sin_sigma
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            cos2_sigma_m = np.where(cos_sq_alpha != 0, cos_sigma - 2 * (sin_reduced1 * sin_reduced2 / cos_sq_alpha), 0.0)
+            C = f / 16. * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            new_lambda_lons = delta_lons + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * (cos2_sigma_m + C * cos_sigma * (-1 + 2 * cos2_sigma_m ** 2)))
+            is_converged |= (sin_sigma == 0) | (np.abs(new_lambda_lons - lambda_lons) <= VINCENTY_CONVERGENCE_THRESHOLD)
+            if np.all(is_converged):
+                break
+            lambda_lons = np.where(is_converged, lambda_lons, new_lambda_lons)
+        u_sq = cos_sq_alpha * (ELLIPSOID_MAJOR_KM ** 2 - ELLIPSOID_MINOR_KM ** 2) / ELLIPSOID_MINOR_KM ** 2
+        A = 1 + u_sq / 16384. * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        B = u_sq / 1024. * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4. * (cos_sigma * (-1 + 2 * cos2_sigma_m ** 2) - B / 6. * cos2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos2_sigma_m ** 2)))
+        distances = np.where(sin_sigma == 0, 0.0, ELLIPSOID_MINOR_KM * A * (sigma - delta_sigma))
+    if not np.all(is_converged):
+        logging.warning("Vincenty formula failed to converge for " + str(np.sum(~is_converged)) + " pairs of points, which are measured by the great-circle distance")
+        distances[~is_converged] = get_great_circle_distances_in_km(lats1[~is_converged], lons1[~is_converged], lats2[~is_converged], lons2[~is_converged])
+    return distances
+
+def log_report(report):
+    logging.info("Evaluated %d test tweets with %s distances" % (report['n_tweets'], report['distance']))
+    if report['n_tweets'] == 0:
+        return
+    logging.info("meanErrorDistanceInMeters: " + str(report['mean_error_meters']))
+    logging.info("medianErrorDistanceInMeters: " + str(report['median_error_meters']))
+    logging.info("Accuracy of grid cells: %.4f" % report['gridcell_accuracy'])
+    for distance_km in prediction.EVALUATION_ACCURACY_DISTANCES_KM:
+        logging.info("Accuracy within %g km: %.4f" % (distance_km, report['accuracy_within_km']["%g" % distance_km]))
+
+def write_report(report, filename):
+    outfile = open(filename, "wb")
+    json.dump(report, outfile, indent=2, sort_keys=True)
+    outfile.close()
+    logging.info("Wrote the evaluation report to " + filename)
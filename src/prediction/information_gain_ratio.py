@@ -3,46 +3,90 @@
 @license:  See 'LICENSE.md' as part of this package. 
 @precondition:
 @summary: This file includes the functions to calculate information gain ratio for tokens. 
+Information gain ratios of all tokens are calculated together from the token x grid cell counts, 
+which are obtained by multiplying the sparse tweet x token matrix with the tweet x grid cell matrix.
+TokenGridCellCounts maintains these counts, so the information gain ratios are updated with new tweets without counting the previous tweets again.
 '''
 
 import numpy as np
-from math import log
+from scipy import sparse
+from data import token_index
 
-def get_entrophy(grid_assignments):
-    gc_counts = np.bincount(grid_assignments)
-    denominator = float(len(grid_assignments))
+class TokenGridCellCounts:
+    def __init__(self):
+        self.tokens_dictionary = {}
+        self.token_gridcell_counts = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.grid_counts = np.zeros(0, dtype=int)
+
+    def add(self, tgms):
+        if len(tgms) == 0:
+            return
+        for tgm in tgms:
+            for token in tgm.tokens:
+                self.tokens_dictionary.setdefault(token, len(self.tokens_dictionary))
+        grid_assignments = np.array([tgm.gcid for tgm in tgms], dtype=int)
+        n_gridcells = max(len(self.grid_counts), np.max(grid_assignments) + 1)
+        tokens_index = token_index.TokenIndex(self.tokens_dictionary, tgms)
+        token_gridcell_counts = get_token_gridcell_counts(tokens_index.tgm_token_matrix, grid_assignments, n_gridcells)
+        self.token_gridcell_counts = token_index.get_resized_matrix(self.token_gridcell_counts, token_gridcell_counts.shape) + token_gridcell_counts
+        self.token_gridcell_counts.sort_indices()
+        grid_counts = np.bincount(grid_assignments, minlength=n_gridcells)
+        grid_counts[:len(self.grid_counts)] += self.grid_counts
+        self.grid_counts = grid_counts
+
+    def get_inf_gain_ratios(self):
+        igrs = get_inf_gain_ratios_from_counts(self.token_gridcell_counts.astype(np.float64), self.grid_counts.astype(np.float64))
+        return dict((token, float(igrs[i])) for token, i in self.tokens_dictionary.iteritems())
+
+def get_entrophy(gc_counts):
+    denominator = float(np.sum(gc_counts))
     p = gc_counts[np.nonzero(gc_counts)] / denominator 
     return - np.sum(p * np.log(p))
 
-def find_inf_gain_ratio(tgms_training, grid_entropy, token):
-    document_count = len(tgms_training)
-    token_exists_gridcells = []
-    token_not_exists_gridcells = []
-    for tgm in tgms_training:
-        if token in tgm.tokens:
-            token_exists_gridcells.append(tgm.gcid)
-        else:
-            token_not_exists_gridcells.append(tgm.gcid)
-    token_exists_tgm_count = len(token_exists_gridcells)
-    token_not_exists_tgm_count = len(token_not_exists_gridcells)
-    entropy_token_exists = get_entrophy(token_exists_gridcells)
-    entropy_token_not_exists = get_entrophy(token_not_exists_gridcells)
-    inf_gain = grid_entropy - (((1.0 * token_exists_tgm_count / document_count) * entropy_token_exists)
-                             + ((1.0 * token_not_exists_tgm_count / document_count) * entropy_token_not_exists))
-    pw = 1.0 * token_exists_tgm_count / document_count
-    pwx = 1.0 * token_not_exists_tgm_count / document_count
-    intrinsic_entrophy = - pw * log(pw) - pwx * log(pwx)
-    igr = inf_gain / intrinsic_entrophy
-    return igr
+def get_log_terms(counts):
+    return counts * np.log(np.where(counts > 0, counts, 1.0))
 
-def find_inf_gain_ratios(tgms_training, tokens_list):
-    inf_gain_ratios = {}
-    grid_assignments = [tgm.gcid for tgm in tgms_training]
-    grid_entropy = get_entrophy(grid_assignments)
-    for token in tokens_list:
-        igr = find_inf_gain_ratio(tgms_training, grid_entropy, token)
-        inf_gain_ratios[token] = igr
-    return inf_gain_ratios
+def get_token_gridcell_counts(tgm_token_matrix, grid_assignments, n_gridcells=None):
+    if n_gridcells is None:
+        n_gridcells = np.max(grid_assignments) + 1
+    tgm_gridcell_matrix = sparse.csr_matrix((np.ones(len(grid_assignments), dtype=tgm_token_matrix.dtype), (np.arange(len(grid_assignments)), grid_assignments)), shape=(len(grid_assignments), n_gridcells))
+    token_gridcell_counts = sparse.csr_matrix(tgm_token_matrix.T.dot(tgm_gridcell_matrix))
+    token_gridcell_counts.sort_indices()
+    return token_gridcell_counts
 
+def get_tokens_of_entries(token_gridcell_counts):
+    return np.repeat(np.arange(token_gridcell_counts.shape[0]), np.diff(token_gridcell_counts.indptr))
 
+def get_entrophies_token_exists(token_gridcell_counts, token_exists_tgm_counts):
+    tokens_of_entries = get_tokens_of_entries(token_gridcell_counts)
+    p = token_gridcell_counts.data / token_exists_tgm_counts[tokens_of_entries]
+    return - np.bincount(tokens_of_entries, weights=p * np.log(p), minlength=len(token_exists_tgm_counts))
+
+def get_entrophies_token_not_exists(token_gridcell_counts, grid_counts, token_not_exists_tgm_counts):
+    # The grid cell counts of tweets without a token are grid_counts minus the counts of the token. Since -sum(p * log(p)) = log(n) - sum(c * log(c)) / n,
+    # the sum over all grid cells is corrected only for the grid cells where the token exists.
+    tokens_of_entries = get_tokens_of_entries(token_gridcell_counts)
+    grid_log_terms = get_log_terms(grid_counts)
+    gc_counts_of_entries = grid_counts[token_gridcell_counts.indices]
+    corrections = get_log_terms(gc_counts_of_entries - token_gridcell_counts.data) - grid_log_terms[token_gridcell_counts.indices]
+    sums_of_log_terms = np.sum(grid_log_terms) + np.bincount(tokens_of_entries, weights=corrections, minlength=len(token_not_exists_tgm_counts))
+    return np.log(token_not_exists_tgm_counts) - sums_of_log_terms / token_not_exists_tgm_counts
+
+def find_inf_gain_ratios(tgms_training, tokens_list):
+    token_gridcell_counts = TokenGridCellCounts()
+    token_gridcell_counts.add(tgms_training)
+    inf_gain_ratios = token_gridcell_counts.get_inf_gain_ratios()
+    return dict((token, inf_gain_ratios[token]) for token in tokens_list)
 
+def get_inf_gain_ratios_from_counts(token_gridcell_counts, grid_counts):
+    document_count = np.sum(grid_counts)
+    grid_entropy = get_entrophy(grid_counts)
+    token_exists_tgm_counts = np.asarray(token_gridcell_counts.sum(axis=1)).ravel()
+    token_not_exists_tgm_counts = document_count - token_exists_tgm_counts
+    entropies_token_exists = get_entrophies_token_exists(token_gridcell_counts, token_exists_tgm_counts)
+    entropies_token_not_exists = get_entrophies_token_not_exists(token_gridcell_counts, grid_counts, token_not_exists_tgm_counts)
+    pw = token_exists_tgm_counts / document_count
+    pwx = token_not_exists_tgm_counts / document_count
+    inf_gains = grid_entropy - ((pw * entropies_token_exists) + (pwx * entropies_token_not_exists))
+    intrinsic_entrophies = - pw * np.log(pw) - pwx * np.log(pwx)
+    return inf_gains / intrinsic_entrophies
@@ -0,0 +1,103 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: This file includes the class definition of a disk cache for the probabilities of grid cells computed for the kernels of tokens.
+Each probability vector is stored in a .npy file named by the SHA-1 of the observations, the bandwidth and the grid, 
+so a token is fitted again only if any of them changes. 
+The least recently used files are removed when the cache exceeds its size bound. The modification time of a file is its last use.
+'''
+
+import hashlib
+import logging
+import os
+import numpy as np
+
+CACHE_FILE_SUFFIX = ".npy"
+# The cache is reduced to this ratio of its maximum size while evicting, so that evictions are not repeated for every new file
+EVICTION_TARGET_RATIO = 0.9
+
+class KDECache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file_sizes = {}
+        for filename in os.listdir(directory):
+            if filename.endswith(CACHE_FILE_SUFFIX):
+                self.file_sizes[filename[:-len(CACHE_FILE_SUFFIX)]] = os.path.getsize(os.path.join(directory, filename))
+        self.total_bytes = sum(self.file_sizes.values())
+        # files that will be read soon, which are evicted only after the other files
+        self.keys_in_use = set()
+        logging.debug("KDE cache at " + directory + " has " + str(len(self.file_sizes)) + " files and " + str(self.total_bytes) + " bytes")
+        # a cache that was filled with a larger bound is reduced at once, also for runs that only read it
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + CACHE_FILE_SUFFIX)
+
+    def contains(self, key):
+        return key in self.file_sizes
+
+    def reserve(self, key):
+        self.keys_in_use.add(key)
+
+    def get(self, key):
+        self.keys_in_use.discard(key)
+        if key not in self.file_sizes:
+            return None
+        try:
+            gc_probabilities = np.load(self.get_path(key))
+            os.utime(self.get_path(key), None)
+        except (IOError, OSError, ValueError):
+            # removed or being replaced by another process
+            self.remove(key)
+            return None
+        return gc_probabilities
+
+    def put(self, key, gc_probabilities):
+        temporary_path = self.get_path(key) + "." + str(os.getpid()) + ".tmp"
+        outfile = open(temporary_path, "wb")
+        np.save(outfile, gc_probabilities)
+        outfile.close()
+        os.rename(temporary_path, self.get_path(key))
+        self.total_bytes += os.path.getsize(self.get_path(key)) - self.file_sizes.get(key, 0)
+        self.file_sizes[key] = os.path.getsize(self.get_path(key))
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def remove(self, key):
+        if os.path.exists(self.get_path(key)):
+            os.remove(self.get_path(key))
+        self.total_bytes -= self.file_sizes.pop(key, 0)
+
+    def evict(self):
+        last_uses = []
+        for key in self.file_sizes:
+            try:
+                last_uses.append((key in self.keys_in_use, os.path.getmtime(self.get_path(key)), key))
+            except OSError:
+                last_uses.append((False, 0, key))
+        last_uses.sort()
+        n_evicted = 0
+        for _, _, key in last_uses:
+            if self.total_bytes <= EVICTION_TARGET_RATIO * self.max_bytes:
+                break
+            self.remove(key)
+            n_evicted += 1
+        logging.debug("Evicted " + str(n_evicted) + " files from KDE cache")
+
+def get_cache_key(observation_lats, observation_lons, bw, grid_fingerprint, integration_settings):
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(observation_lats, dtype=np.float64).tobytes())
+    sha1.update(np.ascontiguousarray(observation_lons, dtype=np.float64).tobytes())
+    sha1.update(repr(float(bw)).encode('ascii'))
+    sha1.update(grid_fingerprint.encode('ascii'))
+    sha1.update(integration_settings.encode('ascii'))
+    return sha1.hexdigest()
+
+def get_grid_fingerprint(grid):
+    grid_array = np.column_stack((grid.gcids, grid.latmins, grid.lonmins, grid.latmaxs, grid.lonmaxs)).astype(np.float64)
+    return hashlib.sha1(grid_array.tobytes()).hexdigest()
@@ -0,0 +1,131 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: This file includes the functions to integrate a two dimensional gaussian_kde over all cells of a grid at once.
+The cumulative distribution function (CDF) of the kernel is evaluated at the corners of grid cells, and the probability of each cell is obtained from 
+the CDF values at its four corners. The corners of neighboring cells are shared in regular grids, so each corner is evaluated only once.
+The CDF of a bivariate normal distribution is calculated with the algorithm of A. Genz (2004), Numerical computation of rectangular bivariate
+and trivariate normal and t probabilities, Statistics and Computing, which is also used by gaussian_kde.integrate_box for two dimensions.
+'''
+
+import numpy as np
+from scipy import special
+
+# Upper bound for the number of CDF values calculated at once
+MAX_CDF_EVALUATIONS_IN_CHUNK = 2**20
+
+# Gauss-Legendre points and weights of Genz's algorithm for |r| < 0.3, |r| < 0.75 and higher correlations
+GAUSS_LEGENDRE_6_WEIGHTS = [0.1713244923791705, 0.3607615730481384, 0.4679139345726904]
+GAUSS_LEGENDRE_6_POINTS = [0.9324695142031522, 0.6612093864662647, 0.2386191860831970]
+GAUSS_LEGENDRE_12_WEIGHTS = [0.04717533638651177, 0.1069393259953183, 0.1600783285433464, 0.2031674267230659, 0.2334925365383547, 0.2491470458134029]
+GAUSS_LEGENDRE_12_POINTS = [0.9815606342467191, 0.9041172563704750, 0.7699026741943050, 0.5873179542866171, 0.3678314989981802, 0.1252334085114692]
+GAUSS_LEGENDRE_20_WEIGHTS = [0.01761400713915212, 0.04060142980038694, 0.06267204833410906, 0.08327674157670475, 0.1019301198172404,
+                             0.1181945319615184, 0.1316886384491766, 0.1420961093183821, 0.1491729864726037, 0.1527533871307259]
+GAUSS_LEGENDRE_20_POINTS = [0.9931285991850949, 0.9639719272779138, 0.9122344282513259, 0.8391169718222188, 0.7463319064601508,
+                            0.6360536807265150, 0.5108670019508271, 0.3737060887154196, 0.2277858511416451, 0.07652652113349733]
+
+class GridCorners:
+    def __init__(self, grid):
+        latmins, lonmins, latmaxs, lonmaxs = grid.latmins, grid.lonmins, grid.latmaxs, grid.lonmaxs
+        lat_edges, lat_edge_indices = np.unique(np.concatenate((latmins, latmaxs)), return_inverse=True)
+        lon_edges, lon_edge_indices = np.unique(np.concatenate((lonmins, lonmaxs)), return_inverse=True)
+        number_of_cells = len(latmins)
+        if len(lat_edges) * len(lon_edges) <= 4 * number_of_cells:
+            # the corners are the points of the lattice formed by the edges of the cells
+            lattice_lats, lattice_lons = np.meshgrid(lat_edges, lon_edges, indexing='ij')
+            self.lats, self.lons = lattice_lats.ravel(), lattice_lons.ravel()
+            latmin_indices, latmax_indices = lat_edge_indices[:number_of_cells], lat_edge_indices[number_of_cells:]
+            lonmin_indices, lonmax_indices = lon_edge_indices[:number_of_cells], lon_edge_indices[number_of_cells:]
+            self.sw_indices = latmin_indices * len(lon_edges) + lonmin_indices
+            self.se_indices = latmin_indices * len(lon_edges) + lonmax_indices
+            self.nw_indices = latmax_indices * len(lon_edges) + lonmin_indices
+            self.ne_indices = latmax_indices * len(lon_edges) + lonmax_indices
+        else:
+            self.lats = np.concatenate((latmins, latmins, latmaxs, latmaxs))
+            self.lons = np.concatenate((lonmins, lonmaxs, lonmins, lonmaxs))
+            cell_indices = np.arange(number_of_cells)
+            self.sw_indices = cell_indices
+            self.se_indices = cell_indices + number_of_cells
+            self.nw_indices = cell_indices + 2 * number_of_cells
+            self.ne_indices = cell_indices + 3 * number_of_cells
+
+def integrate_kernel_over_grid(kernel, grid_corners):
+    cdf = get_kernel_cdf_at_points(kernel, grid_corners.lats, grid_corners.lons)
+    return cdf[grid_corners.ne_indices] - cdf[grid_corners.nw_indices] - cdf[grid_corners.se_indices] + cdf[grid_corners.sw_indices]
+
+def get_kernel_cdf_at_points(kernel, lats, lons):
+    # The kernel is a mixture of normal distributions with the same covariance, centered at the observations.
+    std_lat = np.sqrt(kernel.covariance[0, 0])
+    std_lon = np.sqrt(kernel.covariance[1, 1])
+    r = kernel.covariance[0, 1] / (std_lat * std_lon)
+    observation_weights = getattr(kernel, 'weights', None)
+    if observation_weights is None:
+        observation_weights = np.ones(kernel.n) / kernel.n
+    cdf = np.zeros(len(lats))
+    chunk_size = max(1, MAX_CDF_EVALUATIONS_IN_CHUNK // len(lats))
+    for chunk_start in range(0, kernel.n, chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        h = (lats[np.newaxis, :] - kernel.dataset[0, chunk, np.newaxis]) / std_lat
+        k = (lons[np.newaxis, :] - kernel.dataset[1, chunk, np.newaxis]) / std_lon
+        cdf += np.dot(observation_weights[chunk], get_bivariate_normal_cdf(h, k, r))
+    return cdf
+
+def get_bivariate_normal_cdf(h, k, r):
+    # P(X < h, Y < k) for standard normal X and Y with correlation r
+    return get_bivariate_normal_upper_probability(-h, -k, r)
+
+def get_bivariate_normal_upper_probability(h, k, r):
+    # P(X > h, Y > k) for standard normal X and Y with correlation r, calculated by Genz's algorithm
+    with np.errstate(all='ignore'):
+        if r == 0:
+            return special.ndtr(-h) * special.ndtr(-k)
+        if abs(r) < 0.3:
+            weights, points = GAUSS_LEGENDRE_6_WEIGHTS, GAUSS_LEGENDRE_6_POINTS
+        elif abs(r) < 0.75:
+            weights, points = GAUSS_LEGENDRE_12_WEIGHTS, GAUSS_LEGENDRE_12_POINTS
+        else:
+            weights, points = GAUSS_LEGENDRE_20_WEIGHTS, GAUSS_LEGENDRE_20_POINTS
+        weights = np.concatenate((weights, weights))
+        points = np.concatenate((1.0 - np.array(points), 1.0 + np.array(points)))
+        two_pi = 2.0 * np.pi
+        hk = h * k
+        if abs(r) < 0.925:
+            hs = (h * h + k * k) / 2.0
+            asr = np.arcsin(r) / 2.0
+            bvn = np.zeros(np.shape(hk))
+            for weight, point in zip(weights, points):
+                sn = np.sin(asr * point)
+                bvn += weight * np.exp((sn * hk - hs) / (1.0 - sn * sn))
+            bvn = bvn * asr / two_pi + special.ndtr(-h) * special.ndtr(-k)
+        else:
+            if r < 0:
+                k = -k
+                hk = -hk
+            bvn = np.zeros(np.shape(hk))
+            if abs(r) < 1:
+                as_ = 1.0 - r * r
+                a = np.sqrt(as_)
+                bs = (h - k) ** 2
+                asr = -(bs / as_ + hk) / 2.0
+                c = (4.0 - hk) / 8.0
+                d = (12.0 - hk) / 80.0
+                bvn = np.where(asr > -100, a * np.exp(asr) * (1.0 - c * (bs - as_) * (1.0 - d * bs) / 3.0 + c * d * as_ * as_), 0.0)
+                b = np.sqrt(bs)
+                sp = np.sqrt(two_pi) * special.ndtr(-b / a)
+                bvn = bvn - np.where(hk > -100, np.exp(-hk / 2.0) * sp * b * (1.0 - c * bs * (1.0 - d * bs) / 3.0), 0.0)
+                a = a / 2.0
+                for weight, point in zip(weights, points):
+                    xs = (a * point) ** 2
+                    asr = -(bs / xs + hk) / 2.0
+                    sp = 1.0 + c * xs * (1.0 + 5.0 * d * xs)
+                    rs = np.sqrt(1.0 - xs)
+                    ep = np.exp(-(hk / 2.0) * xs / (1.0 + rs) ** 2) / rs
+                    bvn = bvn + np.where(asr > -100, a * weight * np.exp(asr) * (ep - sp), 0.0)
+                bvn = -bvn / two_pi
+            if r > 0:
+                bvn = bvn + special.ndtr(-np.maximum(h, k))
+            else:
+                L = np.where(h < 0, special.ndtr(k) - special.ndtr(h), special.ndtr(-h) - special.ndtr(-k))
+                bvn = np.where(h >= k, -bvn, L - bvn)
+        return np.clip(bvn, 0.0, 1.0)
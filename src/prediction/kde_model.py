@@ -0,0 +1,196 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: This file includes the class definition of the trained model of prediction.classifier.KDESum, which performs the predictions.
+The model is a matrix of the probabilities of tokens in grid cells, with the information gain ratios of tokens as the weights of its rows.
+A model is not modified after it is created, so predictions can continue with a model while KDESum creates its updated version.
+A model can be saved to a directory, and loaded with memory-mapped arrays.
+If the model has a quadtree over the grid, it also keeps the matrices of the probabilities of tokens in the cells of each level, and finds 
+the best grid cells of tweets from the coarse cells (see prediction.quadtree). These matrices are saved and memory-mapped with the model.
+'''
+
+import logging
+import os
+import shutil
+import numpy as np
+from scipy import sparse
+import prediction
+from prediction import quadtree
+
+# Arrays of the model that are saved to and loaded from .npy files with the same names
+MODEL_ARRAYS = ['gcids', 'gc_priors', 'token_weights', 'token_discarded_probabilities']
+DENSE_PROBABILITY_ARRAYS = ['probability_matrix']
+SPARSE_PROBABILITY_ARRAYS = ['probability_data', 'probability_indices', 'probability_indptr']
+QUADTREE_ARRAYS = ['gridcell_rows', 'gridcell_cols', 'lat_edges', 'lon_edges', 'root_cells']
+MODEL_TOKENS_FILE = 'model_tokens.txt'
+
+class KDEModel(object):
+    def __init__(self, model_tokens, token_weights, probability_matrix, token_discarded_probabilities, gcids, gc_priors, gcid_with_max_prior, grid_quadtree=None, level_matrices=None, level_lookups=None):
+        # row i of probability_matrix holds the probabilities of model_tokens[i] in the grid cells with gcids
+        self.model_tokens = model_tokens
+        self.token_rows = dict((token, i) for i, token in enumerate(model_tokens))
+        self.token_weights = token_weights
+        self.probability_matrix = probability_matrix
+        self.token_discarded_probabilities = token_discarded_probabilities
+        self.gcids = gcids
+        self.gc_priors = gc_priors
+        self.gcid_with_max_prior = gcid_with_max_prior
+        self.quadtree = grid_quadtree
+        self.level_matrices = level_matrices
+        self.level_lookups = level_lookups
+        if grid_quadtree is not None and level_matrices is None:
+            self.level_matrices = grid_quadtree.get_level_matrices(probability_matrix)
+            self.level_lookups = quadtree.get_probability_lookups(self.level_matrices)
+
+    def get_model_row(self, row):
+        # the row in the format of get_model_row() of prediction.classifier.KDESum
+        if not sparse.issparse(self.probability_matrix):
+            return np.asarray(self.probability_matrix[row])
+        row_slice = slice(self.probability_matrix.indptr[row], self.probability_matrix.indptr[row + 1])
+        return np.asarray(self.probability_matrix.indices[row_slice]), np.asarray(self.probability_matrix.data[row_slice]), self.token_discarded_probabilities[row]
+
+    def get_size_in_bytes(self):
+        if sparse.issparse(self.probability_matrix):
+            return self.probability_matrix.data.nbytes + self.probability_matrix.indices.nbytes + self.probability_matrix.indptr.nbytes + self.token_weights.nbytes
+        return self.probability_matrix.nbytes + self.token_weights.nbytes
+
+    def predict_batch(self, tokens_of_tweets):
+        predicted_gcids = np.empty(len(tokens_of_tweets), dtype=self.gcids.dtype)
+        if self.quadtree is not None:
+            for batch_start in range(0, len(tokens_of_tweets), prediction.PREDICTION_BATCH_SIZE):
+                tweet_token_matrix = self.get_tweet_token_matrix(tokens_of_tweets[batch_start:batch_start + prediction.PREDICTION_BATCH_SIZE])
+                is_empty = np.diff(tweet_token_matrix.indptr) == 0
+                best_columns = quadtree.get_best_columns(self.quadtree, self.level_matrices, self.level_lookups, tweet_token_matrix)
+                predicted_gcids[batch_start:batch_start + len(best_columns)] = np.where(is_empty, self.gcid_with_max_prior, self.gcids[best_columns])
+            return predicted_gcids
+        for batch_start, tweet_token_matrix, gc_probabilities_for_tweets in self.get_gc_probabilities_of_batches(tokens_of_tweets):
+            is_empty = np.diff(tweet_token_matrix.indptr) == 0
+            batch_gcids = np.where(is_empty, self.gcid_with_max_prior, self.gcids[np.argmax(gc_probabilities_for_tweets, axis=1)])
+            predicted_gcids[batch_start:batch_start + len(batch_gcids)] = batch_gcids
+        return predicted_gcids
+
+    def predict_top_k(self, tokens_of_tweets, k):
+        # Returns the k grid cells with the highest scores for each tweet, their scores normalized over all grid cells, and an upper bound 
+        # for the normalized probability dropped by MODEL_PROBABILITY_EPSILON, which is missing from the scores.
+        # The cells of tweets without known tokens are ranked by their prior probabilities.
+        k = min(k, len(self.gcids))
+        top_gcids = np.empty((len(tokens_of_tweets), k), dtype=self.gcids.dtype)
+        top_scores = np.empty((len(tokens_of_tweets), k))
+        discarded_probabilities = np.empty(len(tokens_of_tweets))
+        for batch_start, tweet_token_matrix, gc_probabilities_for_tweets in self.get_gc_probabilities_of_batches(tokens_of_tweets):
+            is_empty = np.diff(tweet_token_matrix.indptr) == 0
+            gc_probabilities_for_tweets[is_empty] = self.gc_priors
+            discarded_scores = tweet_token_matrix.dot(self.token_discarded_probabilities)
+            total_scores = gc_probabilities_for_tweets.sum(axis=1) + discarded_scores
+            total_scores[total_scores == 0] = 1.0
+            top_columns = np.argpartition(-gc_probabilities_for_tweets, k - 1, axis=1)[:, :k]
+            batch_rows = np.arange(len(top_columns))[:, np.newaxis]
+            top_columns = top_columns[batch_rows, np.argsort(-gc_probabilities_for_tweets[batch_rows, top_columns], axis=1)]
+            batch = slice(batch_start, batch_start + len(top_columns))
+            top_gcids[batch] = self.gcids[top_columns]
+            top_scores[batch] = gc_probabilities_for_tweets[batch_rows, top_columns] / total_scores[:, np.newaxis]
+            discarded_probabilities[batch] = discarded_scores / total_scores
+        return top_gcids, top_scores, discarded_probabilities
+
+    def get_gc_probabilities_of_batches(self, tokens_of_tweets):
+        for batch_start in range(0, len(tokens_of_tweets), prediction.PREDICTION_BATCH_SIZE):
+            tweet_token_matrix = self.get_tweet_token_matrix(tokens_of_tweets[batch_start:batch_start + prediction.PREDICTION_BATCH_SIZE])
+            gc_probabilities_for_tweets = tweet_token_matrix.dot(self.probability_matrix)
+            if sparse.issparse(gc_probabilities_for_tweets):
+                gc_probabilities_for_tweets = gc_probabilities_for_tweets.toarray()
+            yield batch_start, tweet_token_matrix, np.asarray(gc_probabilities_for_tweets)
+
+    def get_tweet_token_matrix(self, tokens_of_tweets):
+        # each token of a tweet is counted once with the weight of its row, as the tokens are treated as a set
+        indptr = [0]
+        rows = []
+        for tokens_in_tweet in tokens_of_tweets:
+            rows.extend(set(self.token_rows[token] for token in tokens_in_tweet if token in self.token_rows))
+            indptr.append(len(rows))
+        rows = np.array(rows, dtype=int)
+        return sparse.csr_matrix((self.token_weights[rows], rows, indptr), shape=(len(tokens_of_tweets), len(self.model_tokens)))
+
+    def save(self, directory):
+        # The arrays are written to a temporary directory that replaces the previous model, so a loaded model that memory-maps
+        # the files of the previous model, which may be this model, keeps reading them while they are replaced.
+        directory = os.path.abspath(directory)
+        temporary_directory = directory + "." + str(os.getpid()) + ".tmp"
+        if os.path.exists(temporary_directory):
+            shutil.rmtree(temporary_directory)
+        os.makedirs(temporary_directory)
+        if sparse.issparse(self.probability_matrix):
+            probability_arrays = dict(zip(SPARSE_PROBABILITY_ARRAYS, [self.probability_matrix.data, self.probability_matrix.indices, self.probability_matrix.indptr]))
+        else:
+            probability_arrays = dict(zip(DENSE_PROBABILITY_ARRAYS, [self.probability_matrix]))
+        for name, array in probability_arrays.items():
+            np.save(os.path.join(temporary_directory, name + '.npy'), array)
+        for name in MODEL_ARRAYS:
+            np.save(os.path.join(temporary_directory, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(temporary_directory, 'gcid_with_max_prior.npy'), np.array(self.gcid_with_max_prior))
+        if self.quadtree is not None:
+            for name in QUADTREE_ARRAYS:
+                np.save(os.path.join(temporary_directory, 'quadtree_' + name + '.npy'), np.asarray(getattr(self.quadtree, name)))
+            # level 0 is the probability matrix
+            for level, level_matrix in enumerate(self.level_matrices[1:], 1):
+                if sparse.issparse(level_matrix):
+                    for name, array in zip(SPARSE_PROBABILITY_ARRAYS, [level_matrix.data, level_matrix.indices, level_matrix.indptr]):
+                        np.save(os.path.join(temporary_directory, 'quadtree_level_%d_%s.npy' % (level, name)), array)
+                else:
+                    np.save(os.path.join(temporary_directory, 'quadtree_level_%d_%s.npy' % (level, DENSE_PROBABILITY_ARRAYS[0])), level_matrix)
+            for level, level_lookup in enumerate(self.level_lookups):
+                if level_lookup is not None:
+                    np.save(os.path.join(temporary_directory, 'quadtree_level_%d_lookup.npy' % level), level_lookup)
+        outfile = open(os.path.join(temporary_directory, MODEL_TOKENS_FILE), "wb")
+        outfile.write("".join(token.encode('utf-8') + "\n" for token in self.model_tokens))
+        outfile.close()
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(temporary_directory, directory)
+        logging.info("Saved the model to " + directory)
+
+def create_model(model_tokens, model_rows, token_weights, gcids, gc_priors, gcid_with_max_prior, grid_quadtree=None):
+    # model_rows are in the format of get_model_row() of prediction.classifier.KDESum
+    if prediction.MODEL_PROBABILITY_EPSILON is None:
+        probability_matrix = np.vstack(model_rows) if len(model_rows) > 0 else np.zeros((0, len(gcids)), dtype=np.float32)
+        token_discarded_probabilities = np.zeros(len(model_tokens))
+    else:
+        indptr = np.cumsum([0] + [len(columns) for columns, _, _ in model_rows])
+        indices = np.concatenate([columns for columns, _, _ in model_rows] + [np.zeros(0, dtype=int)])
+        probabilities = np.concatenate([row_probabilities for _, row_probabilities, _ in model_rows] + [np.zeros(0, dtype=np.float32)])
+        probability_matrix = sparse.csr_matrix((probabilities, indices, indptr), shape=(len(model_tokens), len(gcids)))
+        token_discarded_probabilities = np.array([discarded_probability for _, _, discarded_probability in model_rows])
+    return KDEModel(model_tokens, token_weights, probability_matrix, token_discarded_probabilities, gcids, gc_priors, gcid_with_max_prior, grid_quadtree)
+
+def load_model(directory, mmap_mode='r'):
+    # The arrays are memory-mapped with mmap_mode, so the processes that load the same model share their pages.
+    gcids, gc_priors, token_weights, token_discarded_probabilities = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in MODEL_ARRAYS]
+    gcid_with_max_prior = np.load(os.path.join(directory, 'gcid_with_max_prior.npy'))[()]
+    infile = open(os.path.join(directory, MODEL_TOKENS_FILE), "rb")
+    model_tokens = [unicode(line.rstrip('\n'), 'utf-8') for line in infile]
+    infile.close()
+    if os.path.exists(os.path.join(directory, 'probability_matrix.npy')):
+        probability_matrix = np.load(os.path.join(directory, 'probability_matrix.npy'), mmap_mode=mmap_mode)
+    else:
+        probability_data, probability_indices, probability_indptr = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in SPARSE_PROBABILITY_ARRAYS]
+        probability_matrix = sparse.csr_matrix((probability_data, probability_indices, probability_indptr), shape=(len(model_tokens), len(gcids)))
+    grid_quadtree, level_matrices, level_lookups = None, None, None
+    if os.path.exists(os.path.join(directory, 'quadtree_gridcell_rows.npy')):
+        # the levels of the saved quadtree are rebuilt with its own bound for the number of cells at the top level
+        grid_quadtree = quadtree.GridQuadtree(*[np.load(os.path.join(directory, 'quadtree_' + name + '.npy'))[()] for name in QUADTREE_ARRAYS])
+        level_matrices, level_lookups = load_level_matrices(directory, grid_quadtree, probability_matrix, mmap_mode)
+    logging.info("Loaded the model with " + str(len(model_tokens)) + " tokens from " + directory)
+    return KDEModel(model_tokens, token_weights, probability_matrix, token_discarded_probabilities, gcids, gc_priors, gcid_with_max_prior, grid_quadtree, level_matrices, level_lookups)
+
+def load_level_matrices(directory, grid_quadtree, probability_matrix, mmap_mode):
+    level_matrices, level_lookups = [probability_matrix], []
+    for level in range(1, grid_quadtree.top_level + 1):
+        if sparse.issparse(probability_matrix):
+            level_data, level_indices, level_indptr = [np.load(os.path.join(directory, 'quadtree_level_%d_%s.npy' % (level, name)), mmap_mode=mmap_mode) for name in SPARSE_PROBABILITY_ARRAYS]
+            level_matrices.append(sparse.csr_matrix((level_data, level_indices, level_indptr), shape=(probability_matrix.shape[0], grid_quadtree.get_number_of_cells(level))))
+        else:
+            level_matrices.append(np.load(os.path.join(directory, 'quadtree_level_%d_%s.npy' % (level, DENSE_PROBABILITY_ARRAYS[0])), mmap_mode=mmap_mode))
+    for level in range(grid_quadtree.top_level + 1):
+        level_lookup_path = os.path.join(directory, 'quadtree_level_%d_lookup.npy' % level)
+        level_lookups.append(np.load(level_lookup_path, mmap_mode=mmap_mode) if sparse.issparse(probability_matrix) else None)
+    return level_matrices, level_lookups
@@ -3,26 +3,55 @@
 @license:  See 'LICENSE.md' as part of this package. 
 @precondition: data.grid_file, data.training_file and data.test_file must be available in configured paths.
 @summary: This includes the main function to perform prediction. It creates a LocKDE-SCoP classifier and runs the tests on test data. 
+The trained classifier can be saved with --save-model, and loaded with --load-model in later runs instead of training it again.
+The evaluation of predictions is logged, and written as a JSON report with --report.
 '''
 
 import logging
 
 from data import datareader
 import logger_settings
-from prediction import cooc_feature_space, classifier
+from prediction import cooc_feature_space, classifier, evaluation
 import data
-from geopy.distance import vincenty
-import numpy as np
+import argparse
+import time
 
 def main():
+    parser = argparse.ArgumentParser(description='Predicts the locations of the tweets in test data.')
+    parser.add_argument('--save-model', metavar='DIRECTORY', help='Save the trained classifier to DIRECTORY.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes that fit the kernels of tokens in parallel.')
+    parser.add_argument('--load-model', metavar='DIRECTORY', help='Load the classifier saved to DIRECTORY by --save-model instead of training it.')
+    parser.add_argument('--report', metavar='FILE', help='Write the evaluation of predictions to FILE in JSON format.')
+    args = parser.parse_args()
     logger_settings.setLoggers(None)
 
     grid = datareader.readGrid(data.grid_file)
-    tgms_training = datareader.readTweetGridMaps(data.training_file)
-    tgms_test = datareader.readTweetGridMaps(data.test_file)
+    tgms_test = datareader.readTweetGridMaps(data.test_file, grid if data.assign_gridcells else None)
+    if args.load_model is not None:
+        kdeClassifier = classifier.KDESum.load(args.load_model)
+        cooc_feature_space.extend_test_tweets_with_bigrams(tgms_test)
+    else:
+        kdeClassifier = train_classifier(grid, tgms_test, args.workers)
+        log_kde_statistics(kdeClassifier.kde_statistics)
+    if args.save_model is not None:
+        kdeClassifier.save(args.save_model)
+
+    logging.info("classify_test_tweets_using_KDE for %d test items" %len(tgms_test))
+    predicted_gcids = kdeClassifier.predict_batch([tgm_test.tokens for tgm_test in tgms_test])
+    report = evaluation.get_evaluation_report(grid, tgms_test, predicted_gcids)
+    evaluation.log_report(report)
+    if args.report is not None:
+        evaluation.write_report(report, args.report)
+
+def train_classifier(grid, tgms_test, workers=1):
+    stage_start_time = time.time()
+    tgms_training = datareader.readTweetGridMaps(data.training_file, grid if data.assign_gridcells else None)
+    tgms_training_original = cooc_feature_space.copy_tgms(tgms_training)
     tokens_set = set()
     for tgm in tgms_training:
-        tokens_set = tokens_set.union(set(tgm.tokens))
+        tokens_set.update(tgm.tokens)
+    logging.info("Stage reading training data: %.2f seconds" % (time.time() - stage_start_time))
+    stage_start_time = time.time()
     tokens_list = list(tokens_set)
     tokens_list.sort()
     tokens_dictionary = {}
@@ -31,25 +60,27 @@ def main():
         tokens_dictionary[token] = i
     cooc_feature_space.extend_feature_space_with_bigrams(tgms_training, tgms_test, tokens_set)
     tgms_training = get_tgms_with_tokens(tgms_training, tokens_set)
+    logging.info("Stage extending feature space with bigrams: %.2f seconds" % (time.time() - stage_start_time))
     logging.info('Running predictions using ' + str(len(tokens_set)) + ' features in the training set')
     
-    kdeClassifier = classifier.KDESum(grid, tgms_training, tokens_set)
-    logging.info("classify_test_tweets_using_KDE for %d test items" %len(tgms_test))
-    tgms_test_predicted_gcid_dict = {}
-    for i in range(len(tgms_test)):
-        tgm_test = tgms_test[i]
-        predicted_gcid = kdeClassifier.predictLocation(set(tgm_test.tokens))
-        tgms_test_predicted_gcid_dict[i] = predicted_gcid
-        
-    errorDistancesInMeters = []
-    for i in range(len(tgms_test)):
-        tgm_test = tgms_test[i]
-        predicted_gcid = tgms_test_predicted_gcid_dict[i]
-        predlat = (grid[predicted_gcid].latmin + grid[predicted_gcid].latmax) / 2.0
-        predlon = (grid[predicted_gcid].lonmin + grid[predicted_gcid].lonmax) / 2.0 
-        distanceInMeters = float(vincenty((tgm_test.lat, tgm_test.lon), (predlat, predlon)).meters)
-        errorDistancesInMeters.append(distanceInMeters)
-    logging.info("medianErrorDistanceInMeters: " + str(np.median(errorDistancesInMeters)))
+    kdeClassifier = classifier.KDESum(grid, tgms_training, tokens_set, workers, tgms_training_original)
+    for stage, seconds in kdeClassifier.stage_seconds:
+        logging.info("Stage %s: %.2f seconds" % (stage, seconds))
+    return kdeClassifier
+
+def log_kde_statistics(kde_statistics):
+    logging.info("Integrated exactly: %d tokens in %.2f seconds" % (kde_statistics['exact_tokens'], kde_statistics['exact_seconds']))
+    if kde_statistics['cached_tokens'] > 0:
+        logging.info("Found in KDE cache: %d tokens" % kde_statistics['cached_tokens'])
+    if kde_statistics['quadtree_tokens'] > 0:
+        logging.info("Integrated over the quadtree: %d tokens in %.2f seconds, %.1f CDF evaluations per token"
+                     % (kde_statistics['quadtree_tokens'], kde_statistics['quadtree_seconds'], kde_statistics['quadtree_cdf_evaluations'] / kde_statistics['quadtree_tokens']))
+    if kde_statistics['binned_tokens'] > 0:
+        logging.info("Approximated by binning: %d tokens in %.2f seconds" % (kde_statistics['binned_tokens'], kde_statistics['binned_seconds']))
+    if kde_statistics['binned_checked_tokens'] > 0:
+        logging.info("Binned vs. exact for %d tokens: %.4f vs. %.4f seconds, max abs error of a cell: %g, max total variation distance: %g"
+                     % (kde_statistics['binned_checked_tokens'], kde_statistics['binned_checked_seconds'], kde_statistics['binned_checked_exact_seconds'],
+                        kde_statistics['binned_max_abs_error'], kde_statistics['binned_max_total_variation']))
 
 def get_tgms_with_tokens(tgms, tokens):
     tgms_with_frequent_tokens = []
@@ -0,0 +1,183 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition: The grid must be regular.
+@summary: This file includes the class definition of a quadtree of coarse cells over a regular grid, and the functions that use it in training and prediction.
+Level 0 of the quadtree is the grid, and each cell of a level covers 2x2 cells of the level below. The top level has at most QUADTREE_ROOT_CELLS cells.
+In training, the probabilities of a token are integrated over the top level first, and only the cells with probabilities of at least
+MODEL_PROBABILITY_EPSILON are refined. The probability of a cell that is not refined is divided evenly among its grid cells, which are all below the epsilon.
+In prediction, the probability of a token in a coarse cell is its maximum probability in the grid cells it covers, so the score of a coarse cell is 
+an upper bound for the scores of its grid cells. A greedy descent finds a grid cell for each tweet, and only the cells whose scores are at least 
+the score of this grid cell are refined, so the best grid cell is the same as in scoring all grid cells.
+'''
+
+import numpy as np
+from scipy import sparse
+from prediction import kde_integration
+import prediction
+
+# Relative tolerance of the comparisons between the scores of cells at different levels, which are summed in different orders
+SCORE_TOLERANCE = 1e-9
+
+class GridQuadtree:
+    def __init__(self, gridcell_rows, gridcell_cols, lat_edges, lon_edges, root_cells=None):
+        # gridcell_rows[i] and gridcell_cols[i] are the row and column of the grid cell in column i of the model
+        self.gridcell_rows = gridcell_rows
+        self.gridcell_cols = gridcell_cols
+        self.lat_edges = lat_edges
+        self.lon_edges = lon_edges
+        self.root_cells = int(root_cells) if root_cells is not None else prediction.QUADTREE_ROOT_CELLS
+        self.n_rows, self.n_cols = len(lat_edges) - 1, len(lon_edges) - 1
+        lattice_lats, lattice_lons = np.meshgrid(lat_edges, lon_edges, indexing='ij')
+        self.lattice_lats, self.lattice_lons = lattice_lats.ravel(), lattice_lons.ravel()
+        # the cells of each level in row-major order, and their rows and columns
+        self.level_shapes = [(self.n_rows, self.n_cols)]
+        self.level_rows = [np.asarray(gridcell_rows)]
+        self.level_cols = [np.asarray(gridcell_cols)]
+        while self.level_shapes[-1][0] * self.level_shapes[-1][1] > self.root_cells and max(self.level_shapes[-1]) > 1:
+            n_level_rows, n_level_cols = (self.level_shapes[-1][0] + 1) // 2, (self.level_shapes[-1][1] + 1) // 2
+            self.level_shapes.append((n_level_rows, n_level_cols))
+            self.level_rows.append(np.repeat(np.arange(n_level_rows), n_level_cols))
+            self.level_cols.append(np.tile(np.arange(n_level_cols), n_level_rows))
+        self.top_level = len(self.level_shapes) - 1
+        # children_indptr[l] and children[l] list the cells of level l-1 under each cell of level l, and gridcells_indptr[l] and gridcells[l] the grid cells
+        self.parents, self.children_indptr, self.children, self.gridcells_indptr, self.gridcells = [None], [None], [None], [None], [None]
+        for level in range(1, self.top_level + 1):
+            parents = (self.level_rows[level - 1] // 2) * self.level_shapes[level][1] + self.level_cols[level - 1] // 2
+            self.parents.append(parents)
+            self.children_indptr.append(np.r_[0, np.cumsum(np.bincount(parents, minlength=self.get_number_of_cells(level)))])
+            self.children.append(np.argsort(parents, kind='mergesort'))
+            cells_of_gridcells = (self.level_rows[0] >> level) * self.level_shapes[level][1] + (self.level_cols[0] >> level)
+            self.gridcells_indptr.append(np.r_[0, np.cumsum(np.bincount(cells_of_gridcells, minlength=self.get_number_of_cells(level)))])
+            self.gridcells.append(np.argsort(cells_of_gridcells, kind='mergesort'))
+
+    def get_number_of_cells(self, level):
+        return self.level_shapes[level][0] * self.level_shapes[level][1]
+
+    def get_children(self, level, cells):
+        return get_ranges(self.children_indptr[level], self.children[level], cells)
+
+    def get_gridcells(self, level, cells):
+        return get_ranges(self.gridcells_indptr[level], self.gridcells[level], cells)
+
+    def get_corners(self, level, cells):
+        # the indices of the south-west, south-east, north-west and north-east corners of cells in the lattice of grid cell edges
+        row_min, col_min = self.level_rows[level][cells] << level, self.level_cols[level][cells] << level
+        row_max, col_max = np.minimum((self.level_rows[level][cells] + 1) << level, self.n_rows), np.minimum((self.level_cols[level][cells] + 1) << level, self.n_cols)
+        n_lattice_cols = self.n_cols + 1
+        return row_min * n_lattice_cols + col_min, row_min * n_lattice_cols + col_max, row_max * n_lattice_cols + col_min, row_max * n_lattice_cols + col_max
+
+    def get_level_matrices(self, probability_matrix):
+        # The probabilities of the cells of each level are the maximums of the probabilities of their children. Sparse matrices stay sparse.
+        level_matrices = [probability_matrix]
+        for level in range(1, self.top_level + 1):
+            n_level_cells = self.get_number_of_cells(level)
+            if sparse.issparse(probability_matrix):
+                children_matrix = level_matrices[-1]
+                rows = np.repeat(np.arange(children_matrix.shape[0], dtype=np.int64), np.diff(children_matrix.indptr))
+                keys = rows * n_level_cells + self.parents[level][children_matrix.indices]
+                order = np.argsort(keys, kind='mergesort')
+                is_first = np.r_[True, keys[order][1:] != keys[order][:-1]] if len(keys) > 0 else np.zeros(0, dtype=bool)
+                level_keys = keys[order][is_first]
+                level_data = np.maximum.reduceat(children_matrix.data[order], np.flatnonzero(is_first)) if len(keys) > 0 else np.zeros(0, dtype=children_matrix.dtype)
+                level_indptr = np.r_[0, np.cumsum(np.bincount(level_keys // n_level_cells, minlength=children_matrix.shape[0]))]
+                level_matrix = sparse.csr_matrix((level_data, level_keys % n_level_cells, level_indptr), shape=(children_matrix.shape[0], n_level_cells))
+            else:
+                level_matrix = np.maximum.reduceat(np.asarray(level_matrices[-1])[:, self.children[level]], self.children_indptr[level][:-1], axis=1)
+            level_matrices.append(level_matrix)
+        return level_matrices
+
+def get_quadtree(grid):
+    if not grid.is_regular:
+        return None
+    return GridQuadtree(np.searchsorted(grid.lat_edges, grid.latmins), np.searchsorted(grid.lon_edges, grid.lonmins), grid.lat_edges, grid.lon_edges)
+
+def get_ranges(indptr, values, cells):
+    # concatenates values[indptr[c]:indptr[c+1]] for the cells, and returns them with the length of each range
+    counts = indptr[cells + 1] - indptr[cells]
+    range_starts = np.cumsum(counts) - counts
+    positions = np.repeat(indptr[cells] - range_starts, counts) + np.arange(np.sum(counts))
+    return values[positions], counts
+
+def integrate_kernel_over_quadtree(kernel, quadtree, epsilon):
+    cdf = np.full(len(quadtree.lattice_lats), np.nan)
+    gc_probabilities = np.zeros(len(quadtree.gridcell_rows))
+    cells = np.arange(quadtree.get_number_of_cells(quadtree.top_level))
+    n_cdf_evaluations = 0
+    for level in range(quadtree.top_level, -1, -1):
+        sw_points, se_points, nw_points, ne_points = quadtree.get_corners(level, cells)
+        corner_points = np.concatenate((sw_points, se_points, nw_points, ne_points))
+        new_points = np.unique(corner_points[np.isnan(cdf[corner_points])])
+        if len(new_points) > 0:
+            cdf[new_points] = kde_integration.get_kernel_cdf_at_points(kernel, quadtree.lattice_lats[new_points], quadtree.lattice_lons[new_points])
+            n_cdf_evaluations += len(new_points)
+        cell_probabilities = cdf[ne_points] - cdf[nw_points] - cdf[se_points] + cdf[sw_points]
+        if level == 0:
+            gc_probabilities[cells] = cell_probabilities
+            break
+        is_refined = cell_probabilities >= epsilon
+        gridcells, counts = quadtree.get_gridcells(level, cells[~is_refined])
+        gc_probabilities[gridcells] = np.repeat(cell_probabilities[~is_refined] / counts, counts)
+        cells, _ = quadtree.get_children(level, cells[is_refined])
+    return gc_probabilities, n_cdf_evaluations
+
+def get_probability_lookups(level_matrices):
+    # The entries of a sparse matrix are found by binary search over their keys, which are sorted since the indices of each row are sorted.
+    lookups = []
+    for level_matrix in level_matrices:
+        if sparse.issparse(level_matrix):
+            rows = np.repeat(np.arange(level_matrix.shape[0], dtype=np.int64), np.diff(level_matrix.indptr))
+            lookups.append(rows * level_matrix.shape[1] + level_matrix.indices)
+        else:
+            lookups.append(None)
+    return lookups
+
+def get_probabilities(level_matrix, lookup, tokens, cells):
+    if lookup is None:
+        return level_matrix[tokens, cells]
+    keys = tokens.astype(np.int64) * level_matrix.shape[1] + cells
+    if len(lookup) == 0:
+        return np.zeros(len(keys))
+    positions = np.minimum(np.searchsorted(lookup, keys), len(lookup) - 1)
+    return np.where(lookup[positions] == keys, level_matrix.data[positions], 0.0)
+
+def get_scores(level_matrix, lookup, tweet_token_matrix, tweets, cells):
+    # the score of each pair of a tweet and a cell is the sum of the weighted probabilities of the tokens of the tweet in the cell
+    entries, counts = get_ranges(tweet_token_matrix.indptr, np.arange(tweet_token_matrix.nnz), tweets)
+    pairs = np.repeat(np.arange(len(tweets)), counts)
+    probabilities = get_probabilities(level_matrix, lookup, tweet_token_matrix.indices[entries], cells[pairs])
+    return np.bincount(pairs, weights=tweet_token_matrix.data[entries] * probabilities, minlength=len(tweets))
+
+def get_best_columns(quadtree, level_matrices, lookups, tweet_token_matrix):
+    # Returns the column of the grid cell with the highest score for each tweet, and the lowest column among the cells with the same score.
+    n_tweets = tweet_token_matrix.shape[0]
+    top_scores = tweet_token_matrix.dot(level_matrices[quadtree.top_level])
+    top_scores = top_scores.toarray() if sparse.issparse(top_scores) else np.asarray(top_scores)
+    all_tweets = np.arange(n_tweets)
+    # the score of the grid cell found by the greedy descent is a lower bound for the score of the best grid cell
+    greedy_cells = np.argmax(top_scores, axis=1)
+    for level in range(quadtree.top_level, 0, -1):
+        children, counts = quadtree.get_children(level, greedy_cells)
+        tweets = np.repeat(all_tweets, counts)
+        scores = get_scores(level_matrices[level - 1], lookups[level - 1], tweet_token_matrix, tweets, children)
+        greedy_cells = children[get_first_best_pairs(tweets, scores, children)]
+    lower_bounds = get_scores(level_matrices[0], lookups[0], tweet_token_matrix, all_tweets, greedy_cells) * (1.0 - SCORE_TOLERANCE)
+    # all grid cells of a tweet have zero scores if its lower bound is zero, and the first column is the best
+    tweets, cells = np.nonzero((top_scores >= lower_bounds[:, np.newaxis]) & (lower_bounds[:, np.newaxis] > 0))
+    scores = top_scores[tweets, cells]
+    for level in range(quadtree.top_level, 0, -1):
+        children, counts = quadtree.get_children(level, cells)
+        tweets = np.repeat(tweets, counts)
+        scores = get_scores(level_matrices[level - 1], lookups[level - 1], tweet_token_matrix, tweets, children)
+        is_kept = scores >= lower_bounds[tweets] if level > 1 else np.ones(len(children), dtype=bool)
+        tweets, cells, scores = tweets[is_kept], children[is_kept], scores[is_kept]
+    best_columns = np.zeros(n_tweets, dtype=int)
+    best_pairs = get_first_best_pairs(tweets, scores, cells)
+    best_columns[tweets[best_pairs]] = cells[best_pairs]
+    return best_columns
+
+def get_first_best_pairs(tweets, scores, cells):
+    # the pair with the highest score for each tweet, and the lowest cell among the pairs with the same score
+    order = np.lexsort((cells, -scores, tweets))
+    is_first = np.r_[True, tweets[order][1:] != tweets[order][:-1]] if len(order) > 0 else np.zeros(0, dtype=bool)
+    return order[is_first]
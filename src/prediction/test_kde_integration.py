@@ -0,0 +1,73 @@
+'''
+@author Ozer Ozdikis
+@license:  See 'LICENSE.md' as part of this package.
+@precondition:
+@summary: Tests of prediction.kde_integration against gaussian_kde.integrate_box, which integrates the kernel over each cell separately.
+The kernels include negative, zero, low, medium and high correlations, so that every branch of Genz's algorithm is checked.
+'''
+
+import unittest
+import numpy as np
+from scipy import stats, special
+from data.datamodel import GridCell
+from data.grid import Grid
+from prediction import kde_integration
+
+# Maximum absolute difference between the probabilities of a cell
+TOLERANCE = 1e-8
+# Maximum absolute correlation of a kernel that is taken as uncorrelated, since versions of scipy compute covariances in different orders
+ZERO_CORRELATION_TOLERANCE = 1e-12
+
+class TestKDEIntegration(unittest.TestCase):
+    def setUp(self):
+        self.random_state = np.random.RandomState(11)
+
+    def get_kernel(self, correlation, n_observations=30):
+        covariance = np.array([[0.04, 0.03 * correlation], [0.03 * correlation, 0.0225]])
+        observations = self.random_state.multivariate_normal([10.5, 20.5], covariance, n_observations).T
+        return stats.gaussian_kde(observations, 0.5)
+
+    def get_kernels(self):
+        kernels = [self.get_kernel(correlation) for correlation in [-0.99, -0.95, -0.5, -0.1, 0.2, 0.6, 0.8, 0.95, 0.999]]
+        # the observations on a cross have no correlation, and their coordinates are exact in binary so that the covariance is exactly zero
+        kernels.append(stats.gaussian_kde(np.array([[10.25, 10.75, 10.5, 10.5, 10.5], [20.5, 20.5, 20.25, 20.75, 20.5]]), 0.5))
+        correlations = [kernel.covariance[0, 1] / np.sqrt(kernel.covariance[0, 0] * kernel.covariance[1, 1]) for kernel in kernels]
+        # the branches of Genz's algorithm
+        self.assertTrue(any(abs(r) < ZERO_CORRELATION_TOLERANCE for r in correlations))
+        self.assertTrue(any(ZERO_CORRELATION_TOLERANCE <= abs(r) < 0.3 for r in correlations))
+        self.assertTrue(any(0.3 <= abs(r) < 0.75 for r in correlations))
+        self.assertTrue(any(0.75 <= abs(r) < 0.925 for r in correlations))
+        self.assertTrue(any(r >= 0.925 for r in correlations))
+        self.assertTrue(any(r <= -0.925 for r in correlations))
+        return kernels
+
+    def assert_equal_to_integrate_box(self, grid):
+        grid_corners = kde_integration.GridCorners(grid)
+        for kernel in self.get_kernels():
+            gc_probabilities = kde_integration.integrate_kernel_over_grid(kernel, grid_corners)
+            expected_probabilities = [kernel.integrate_box([gridcell.latmin, gridcell.lonmin], [gridcell.latmax, gridcell.lonmax]) for gridcell in grid]
+            np.testing.assert_allclose(gc_probabilities, expected_probabilities, rtol=0, atol=TOLERANCE)
+
+    def test_regular_grid(self):
+        gridcells = []
+        for i in range(8):
+            for j in range(8):
+                gridcells.append(GridCell(i * 8 + j, 10.0 + i * 0.125, 20.0 + j * 0.125, 10.0 + (i + 1) * 0.125, 20.0 + (j + 1) * 0.125))
+        self.assert_equal_to_integrate_box(Grid(gridcells))
+
+    def test_random_cells(self):
+        corners_min = self.random_state.uniform([9.5, 19.5], [11.5, 21.5], (40, 2))
+        corners_max = corners_min + self.random_state.uniform(0.001, 0.5, (40, 2))
+        gridcells = [GridCell(gcid, corners_min[gcid, 0], corners_min[gcid, 1], corners_max[gcid, 0], corners_max[gcid, 1]) for gcid in range(40)]
+        self.assert_equal_to_integrate_box(Grid(gridcells))
+
+    def test_points_far_from_observations(self):
+        kernel = self.get_kernel(0.95)
+        lats = np.array([-80.0, 80.0, 10.5, 10.5, 80.0])
+        lons = np.array([-170.0, 170.0, -170.0, 170.0, -170.0])
+        # far in the east, the CDF is the marginal probability of the latitude
+        lat_probability = np.mean(special.ndtr((10.5 - kernel.dataset[0]) / np.sqrt(kernel.covariance[0, 0])))
+        np.testing.assert_allclose(kde_integration.get_kernel_cdf_at_points(kernel, lats, lons), [0.0, 1.0, 0.0, lat_probability, 0.0], rtol=0, atol=TOLERANCE)
+
+if __name__ == '__main__':
+    unittest.main()